@@ -62,7 +62,7 @@ embedding_model = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL")
 
 
 def get_embedding(text, model=embedding_model):
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    return client.embeddings.create(input=[text], model=model)
 
 
 credential = None
@@ -93,8 +93,10 @@ async def ask_question(ask: Ask):
 
     response: openai.types.chat.chat_completion.ChatCompletion = None
 
-    vector = VectorizedQuery(vector=get_embedding(
-        question), k_nearest_neighbors=5, fields="vector")
+    # keep the embedding response, its tokens count towards the answer as well
+    embedding_response = get_embedding(question)
+    vector = VectorizedQuery(vector=embedding_response.data[0].embedding,
+                             k_nearest_neighbors=5, fields="vector")
 
     # create search client to retrieve movies from the vector store
     found_docs = list(search_client.search(
@@ -142,7 +144,8 @@ async def ask_question(ask: Ask):
     print(question)
     print(answer)
     answer.correlationToken = ask.correlationToken
-    answer.promptTokensUsed = response.usage.prompt_tokens
+    answer.promptTokensUsed = response.usage.prompt_tokens + \
+        embedding_response.usage.prompt_tokens
     answer.completionTokensUsed = response.usage.completion_tokens
 
     return answer
@@ -240,6 +240,9 @@ async def ask_question(ask: Ask):
     )
 
     print(first_response)
+    # every call of the conversation counts towards the tokens of the answer
+    prompt_tokens = first_response.usage.prompt_tokens
+    completion_tokens = first_response.usage.completion_tokens
     response_message = first_response.choices[0].message
     tool_calls = response_message.tool_calls
     print("Recommended Function call:")
@@ -280,15 +283,15 @@ async def ask_question(ask: Ask):
                 messages=messages)
 
             print("second_response")
+            prompt_tokens += second_response.usage.prompt_tokens
+            completion_tokens += second_response.usage.completion_tokens
             messages.append(second_response.choices[0].message)
     if tool_calls:
         answer = Answer(answer=second_response.choices[0].message.content)
-        answer.promptTokensUsed = second_response.usage.prompt_tokens
-        answer.completionTokensUsed = second_response.usage.completion_tokens
     else:
         answer = Answer(answer=first_response.choices[0].message.content)
-        answer.promptTokensUsed = first_response.usage.prompt_tokens
-        answer.completionTokensUsed = first_response.usage.completion_tokens
+    answer.promptTokensUsed = prompt_tokens
+    answer.completionTokensUsed = completion_tokens
     answer.correlationToken = ask.correlationToken
     return answer
 
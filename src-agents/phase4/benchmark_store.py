@@ -0,0 +1,92 @@
+"""
+Measures resident and disk bytes per entry, compaction time, lookup latency
+and recall@1 of the question store modes against a full-precision brute
+force baseline as the cache grows.
+
+    python benchmark_store.py [max_entries] [dim]
+
+Vectors are synthetic: clusters of paraphrases around random topics, queries
+are fresh paraphrases of stored questions.
+"""
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+from question_store import QuestionStore, normalize
+
+modes = ["float32", "float16", "int8", "pq"]
+query_count = 100
+chunk = 10000
+
+
+def paraphrases(rng, topics, count, noise=0.3):
+    picks = rng.integers(0, len(topics), size=count)
+    return normalize(topics[picks] + noise * rng.normal(size=(count, topics.shape[1])).astype(np.float32) / np.sqrt(topics.shape[1]))
+
+
+def brute_force(store_vectors, queries):
+    best_scores = np.full(len(queries), -np.inf)
+    best_rows = np.zeros(len(queries), dtype=np.int64)
+    for start in range(0, len(store_vectors), chunk):
+        scores = queries @ store_vectors[start:start + chunk].T
+        rows = np.argmax(scores, axis=1)
+        better = scores[np.arange(len(queries)), rows] > best_scores
+        best_scores[better] = scores[np.arange(len(queries)), rows][better]
+        best_rows[better] = rows[better] + start
+    return best_rows
+
+
+def main(max_entries, dim):
+    rng = np.random.default_rng(0)
+    topics = normalize(rng.normal(size=(max(1, max_entries // 10), dim)))
+    sizes = [size for size in [10000, 100000, 1000000] if size < max_entries] + [max_entries]
+    directory = tempfile.mkdtemp()
+    baseline = np.lib.format.open_memmap(directory + "/baseline.npy", mode="w+", dtype=np.float32, shape=(max_entries, dim))
+    stores = {mode: QuestionStore(directory + "/" + mode, dim, mode=mode, threshold=-1, segment_size=65536)
+              for mode in modes}
+
+    print("{:>9} {:<8} {:>14} {:>12} {:>12} {:>10} {:>10} {:>8}".format(
+        "entries", "mode", "resident B/e", "disk B/e", "compact ms", "load ms", "lookup ms", "recall@1"))
+    filled = 0
+    compact_ms = {}
+    try:
+        for size in sizes:
+            while filled < size:
+                count = min(chunk, size - filled)
+                vectors = paraphrases(rng, topics, count)
+                baseline[filled:filled + count] = vectors
+                for store in stores.values():
+                    for i, vector in enumerate(vectors):
+                        store.add("question {}".format(filled + i), str(filled + i), vector)
+                    # compact every chunk like the service does, the time of the last one is reported
+                    store.flush()
+                    store.compact()
+                filled += count
+
+            queries = paraphrases(rng, topics, query_count)
+            expected = brute_force(baseline[:size], queries)
+            for mode, store in stores.items():
+                store.flush()
+                compact_ms[mode] = store.last_compaction_ms
+                start = time.perf_counter()
+                store = QuestionStore(directory + "/" + mode, dim, mode=mode, threshold=-1, segment_size=65536)
+                stores[mode] = store
+                load_ms = (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                found = [int(store.search(q)[1]["answer"]) for q in queries]
+                lookup_ms = (time.perf_counter() - start) * 1000 / query_count
+                recall = np.mean(np.asarray(found) == expected)
+                stats = store.stats()
+                print("{:>9} {:<8} {:>14.1f} {:>12.1f} {:>12.0f} {:>10.1f} {:>10.2f} {:>8.3f}".format(
+                    size, mode, stats["bytesPerEntry"], stats["diskBytesPerEntry"], compact_ms[mode],
+                    load_ms, lookup_ms, recall))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    max_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 1536
+    main(max_entries, dim)
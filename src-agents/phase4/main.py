@@ -8,19 +8,12 @@ from enum import Enum
 from openai import AzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 # import redis
-from azure.search.documents.models import (
-    VectorizedQuery
-)
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
+from question_store import QuestionStore
 
 app = FastAPI()
 
 load_dotenv()
 
-credential = AzureKeyCredential(os.environ["AZURE_AI_SEARCH_KEY"]) if len(
-    os.environ["AZURE_AI_SEARCH_KEY"]) > 0 else DefaultAzureCredential()
-
 
 class QuestionType(str, Enum):
     multiple_choice = "multiple_choice"
@@ -84,54 +77,53 @@ def get_embedding(text, model=embedding_model):
     return client.embeddings.create(input=[text], model=model).data[0].embedding
 
 
+# local question cache with quantized vectors in memory-mapped segments
+question_store = QuestionStore(
+    path=os.getenv("QUESTION_STORE_PATH", "question-store"),
+    dim=int(os.getenv("QUESTION_STORE_DIM", "1536")),
+    mode=os.getenv("QUESTION_STORE_MODE", "int8"),
+    threshold=float(os.getenv("QUESTION_STORE_THRESHOLD", "0.9")),
+)
+# merge near-duplicate questions in the background after this many new entries
+compact_every = int(os.getenv("QUESTION_STORE_COMPACT_EVERY", "16384"))
+added_since_compaction = 0
+
+
+@app.on_event("shutdown")
+async def flush_question_store():
+    question_store.flush()
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello Smorgs"}
 
 
+@app.get("/cache", summary="Question cache statistics", operation_id="cache")
+async def cache_stats():
+    """
+    Question cache statistics
+    """
+    return question_store.stats()
+
+
 @app.post("/ask", summary="Ask a question", operation_id="ask")
 async def ask_question(ask: Ask):
     """
     Ask a question
     """
+    global added_since_compaction
     print(ask.question)
-    index_name = "question-semantic-index"
 
-    # create new searchclient using our new index for the questions
-    search_client = SearchClient(
-        endpoint=os.environ["AZURE_AI_SEARCH_ENDPOINT"],
-        index_name=index_name,
-        credential=credential
-    )
+    # look for a similar question in the cache
+    vector = get_embedding(ask.question)
+    found_question = question_store.search(vector)
 
-    # create a vectorized query based on the question
-    vector = VectorizedQuery(vector=get_embedding(
-        ask.question), k_nearest_neighbors=5, fields="vector")
-
-    # create search client to retrieve movies from the vector store
-    found_questions = list(search_client.search(
-        search_text=None,
-        query_type="semantic",
-        semantic_configuration_name="question-semantic-config",
-        vector_queries=[vector],
-        select=["question", "answer"],
-        top=5,
-        minimum_similarity=0.9
-    ))
-
-    questionMatchCount = len(found_questions)
-    if (questionMatchCount > 0):
-        print("Found a match in the cache.")
-        # put the new question & answer in the cache as well
-        docIdCount = search_client.get_document_count() + 1
-        # add the new question and answer to the cache
-        search_client.upload_documents(documents=[
-            {
-                "id": str(docIdCount),
-                "question": ask.question,
-                "answer": response.choices[0].message.content
-            }
-        ])
+    if found_question is not None:
+        score, entry = found_question
+        print("Found a match in the cache with similarity " + str(score))
+        answer = Answer(answer=entry["answer"])
+        answer.correlationToken = ask.correlationToken
         return answer
     else:
         print("No match found in the cache.")
@@ -147,17 +139,17 @@ async def ask_question(ask: Ask):
             messages=messages,
         )
         answer = Answer(answer=response.choices[0].message.content)
+        answer.correlationToken = ask.correlationToken
+        answer.promptTokensUsed = response.usage.prompt_tokens
+        answer.completionTokensUsed = response.usage.completion_tokens
 
         #  put the new question & answer in the cache as well
-        docIdCount = search_client.get_document_count() + 1
-        search_client.upload_documents(documents=[
-            {
-                "id": str(docIdCount),
-                "question": ask.question,
-                "answer": response.choices[0].message.content
-            }
-        ])
+        question_store.add(ask.question, answer.answer, vector)
+        added_since_compaction += 1
+        if added_since_compaction >= compact_every:
+            added_since_compaction = 0
+            question_store.compact_in_background()
 
         print("Added a new answer and question to the cache: " +
-              answer.answer + "in position" + str(docIdCount))
+              answer.answer + " in position " + str(len(question_store)))
         return answer
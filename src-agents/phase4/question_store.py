@@ -0,0 +1,771 @@
+import os
+import json
+import time
+import base64
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# how many rows are scored at once so a large segment never has to be dequantized completely
+block_size = 65536
+# number of centroids per product quantization subspace, codes are stored as uint8
+pq_centroids = 256
+pq_iterations = 10
+# codebooks are only trained once this many centroids' worth of rows is available,
+# segments sealed before that are stored as float16
+pq_train_factor = 4
+pq_train_sample = 16384
+# random hyperplanes per lsh table, a store of N entries uses the first log2(N / lsh_bucket_size) of them.
+# Small buckets keep the exact comparisons cheap, the tables make up for duplicates split by a hyperplane.
+lsh_max_bits = 24
+lsh_min_bits = 8
+lsh_bucket_size = 2
+# new entries compared with the lsh index at once during a compaction
+compact_block = 1024
+# a compacted segment with more deleted rows than this is rewritten on its own
+rewrite_deleted_ratio = 0.3
+seal_retry_seconds = 5
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def train_codebooks(vectors, subvectors, seed=0):
+    """
+    Learn one k-means codebook per subspace for product quantization.
+    """
+    rng = np.random.default_rng(seed)
+    n, dim = vectors.shape
+    sub_dim = dim // subvectors
+    k = min(pq_centroids, n)
+    codebooks = np.empty((subvectors, k, sub_dim), dtype=np.float32)
+    for j in range(subvectors):
+        x = vectors[:, j * sub_dim:(j + 1) * sub_dim]
+        centroids = x[rng.choice(n, size=k, replace=False)].copy()
+        for _ in range(pq_iterations):
+            assignment = nearest_centroids(x, centroids)
+            for c in range(k):
+                members = x[assignment == c]
+                if len(members) > 0:
+                    centroids[c] = members.mean(axis=0)
+        codebooks[j] = centroids
+    return codebooks
+
+
+def nearest_centroids(x, centroids):
+    # argmin ||x - c||^2 is argmax x.c - ||c||^2 / 2
+    return np.argmax(x @ centroids.T - 0.5 * (centroids * centroids).sum(axis=1), axis=1)
+
+
+def encode(mode, vectors, codebooks=None):
+    """
+    Turn normalized float32 vectors into the arrays stored for a segment.
+    """
+    if mode == "float32":
+        return {"codes": vectors.astype(np.float32)}
+    if mode == "float16":
+        return {"codes": vectors.astype(np.float16)}
+    if mode == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return {"codes": codes, "scales": scales.astype(np.float32)}
+    if mode == "pq":
+        subvectors, _, sub_dim = codebooks.shape
+        codes = np.empty((len(vectors), subvectors), dtype=np.uint8)
+        for j in range(subvectors):
+            codes[:, j] = nearest_centroids(vectors[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j])
+        # the full vectors stay on disk and are only paged in to re-rank the best candidates
+        return {"codes": codes, "full": vectors.astype(np.float32)}
+    raise ValueError("Unknown question store mode: " + mode)
+
+
+# number of set bits of every byte value
+bit_counts = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def lsh_index(keys, ids):
+    """
+    Per lsh table the sorted bucket keys of the given entries and their ids in that order.
+    """
+    index = []
+    for t in range(keys.shape[1]):
+        order = np.argsort(keys[:, t], kind="stable")
+        index.append((keys[order, t], ids[order]))
+    return index
+
+
+def shared_buckets(index, query_keys):
+    """
+    Every (query position, id) pair that shares a bucket in at least one lsh table.
+    """
+    queries = []
+    ids = []
+    for t, (keys, order) in enumerate(index):
+        left = np.searchsorted(keys, query_keys[:, t], "left")
+        counts = np.searchsorted(keys, query_keys[:, t], "right") - left
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        queries.append(np.repeat(np.arange(len(query_keys)), counts))
+        # position of the k-th pair is left of its query plus its rank within that query
+        ids.append(order[np.arange(total) + np.repeat(left - np.cumsum(counts) + counts, counts)])
+    if not queries:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # a pair found in several tables is compared once
+    ids = np.concatenate(ids).astype(np.int64)
+    span = int(ids.max()) + 1
+    pairs = np.unique(np.concatenate(queries) * span + ids)
+    return pairs // span, pairs % span
+
+
+class Segment:
+    """
+    A sealed, immutable batch of questions. Vectors and entry offsets are
+    memory-mapped, the question/answer text is read on demand. Compacted
+    segments also keep the lsh signatures of their entries and a mask of
+    the entries that newer duplicates replaced.
+    """
+
+    def __init__(self, directory, name, mode, level=0, compacted=False):
+        self.name = name
+        self.base = os.path.join(directory, name)
+        self.mode = mode
+        self.level = level
+        self.compacted = compacted
+        self.codes = np.load(self.base + ".codes.npy", mmap_mode="r")
+        self.offsets = np.load(self.base + ".offsets.npy", mmap_mode="r")
+        self.scales = np.load(self.base + ".scales.npy", mmap_mode="r") if mode == "int8" else None
+        self.full = np.load(self.base + ".full.npy", mmap_mode="r") if mode == "pq" else None
+        self.signatures = np.load(self.base + ".lsh.npy", mmap_mode="r") if compacted else None
+        self.deleted = None
+        self.deleted_count = 0
+        if os.path.exists(self.base + ".deleted.npy"):
+            self.deleted = np.load(self.base + ".deleted.npy")
+            self.deleted_count = int(self.deleted.sum())
+        # an open handle keeps the entries readable for running lookups after a compaction removed the file
+        self.entries_file = open(self.base + ".entries.jsonl", "rb")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def live(self):
+        return len(self) - self.deleted_count
+
+    def live_rows(self):
+        if self.deleted is None:
+            return np.arange(len(self))
+        return np.flatnonzero(~self.deleted)
+
+    def mark_deleted(self, rows):
+        deleted = np.zeros(len(self), dtype=bool) if self.deleted is None else self.deleted.copy()
+        deleted[rows] = True
+        tmp_path = self.base + ".deleted.tmp.npy"
+        np.save(tmp_path, deleted)
+        os.replace(tmp_path, self.base + ".deleted.npy")
+        self.deleted = deleted
+        self.deleted_count = int(deleted.sum())
+
+    def scores(self, query, start, stop, table=None):
+        if self.mode == "pq":
+            codes = self.codes[start:stop]
+            scores = table[np.arange(codes.shape[1]), codes].sum(axis=1)
+        else:
+            scores = self.codes[start:stop].astype(np.float32) @ query
+            if self.mode == "int8":
+                scores *= self.scales[start:stop]
+        deleted = self.deleted
+        if deleted is not None:
+            scores[deleted[start:stop]] = -np.inf
+        return scores
+
+    def vectors(self, rows):
+        """
+        Best available float32 reconstruction of the given rows.
+        """
+        if self.mode == "pq":
+            return np.asarray(self.full[rows], dtype=np.float32)
+        vectors = np.asarray(self.codes[rows], dtype=np.float32)
+        if self.mode == "int8":
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def arrays(self, rows):
+        arrays = {"codes": np.asarray(self.codes[rows])}
+        if self.scales is not None:
+            arrays["scales"] = np.asarray(self.scales[rows])
+        if self.full is not None:
+            arrays["full"] = np.asarray(self.full[rows])
+        return arrays
+
+    def entry_bytes(self, rows):
+        for row in rows:
+            start = int(self.offsets[row])
+            yield os.pread(self.entries_file.fileno(), int(self.offsets[row + 1]) - start, start)
+
+    def entry(self, row):
+        return json.loads(next(self.entry_bytes([row])))
+
+    def files(self):
+        suffixes = [".codes.npy", ".offsets.npy", ".entries.jsonl"]
+        if self.scales is not None:
+            suffixes.append(".scales.npy")
+        if self.full is not None:
+            suffixes.append(".full.npy")
+        if self.signatures is not None:
+            suffixes.append(".lsh.npy")
+        if self.deleted is not None:
+            suffixes.append(".deleted.npy")
+        return [self.base + suffix for suffix in suffixes]
+
+    def nbytes(self):
+        """
+        Bytes that are read for every lookup, the pq full vectors are only paged in to re-rank.
+        """
+        resident = self.codes.nbytes + self.offsets.nbytes
+        if self.scales is not None:
+            resident += self.scales.nbytes
+        if self.deleted is not None:
+            resident += self.deleted.nbytes
+        return resident
+
+    def disk_bytes(self):
+        disk = self.nbytes() + int(self.offsets[-1])
+        if self.full is not None:
+            disk += self.full.nbytes
+        if self.signatures is not None:
+            disk += self.signatures.nbytes
+        return disk
+
+
+class QuestionStore:
+    """
+    Question/answer cache with quantized vectors in memory-mapped segments.
+
+    New questions are appended to a log and kept in an in-memory active
+    segment that is sealed to disk by a background thread once it holds
+    segment_size entries. Lookups score every segment on its compact codes,
+    re-rank the best candidates exactly where full vectors are kept (pq) and
+    return the closest entry above the threshold. compact() removes
+    near-duplicate questions, keeping the newest answer, and merges
+    compacted segments in tiers.
+    """
+
+    def __init__(self, path, dim, mode="int8", segment_size=4096, threshold=0.9, rerank=32,
+                 pq_subvectors=None, duplicate_threshold=0.98, lsh_tables=8, merge_factor=4):
+        self.path = path
+        self.dim = dim
+        self.mode = mode
+        self.segment_size = segment_size
+        self.threshold = threshold
+        self.rerank = rerank
+        self.pq_subvectors = pq_subvectors or max(1, dim // 16)
+        self.duplicate_threshold = duplicate_threshold
+        self.lsh_tables = lsh_tables
+        self.merge_factor = merge_factor
+        if mode == "pq" and dim % self.pq_subvectors != 0:
+            raise ValueError("dim must be divisible by pq_subvectors")
+        self.hyperplanes = np.random.default_rng(0).normal(
+            size=(dim, lsh_tables * lsh_max_bits)).astype(np.float32)
+        # a hyperplane separates two vectors with probability angle / pi, duplicates differ in
+        # few of their signature bits and pairs that differ in many more need no exact comparison
+        hyperplanes = lsh_tables * lsh_max_bits
+        separated = np.arccos(min(1.0, duplicate_threshold)) / np.pi
+        self.max_differing_bits = hyperplanes * separated + 6 * np.sqrt(hyperplanes * separated * (1 - separated))
+
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.segments = []
+        self.next_segment = 0
+        self.codebooks = None
+        self.train_lock = threading.Lock()
+        # a single sealer thread keeps the segments in the order they were filled
+        self.sealer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="question-store-sealer")
+        self.sealing = []
+        self.active_vectors = []
+        self.active_entries = []
+        self.active_matrix = None
+        self.next_log = 0
+        self.log = None
+        self.compactions = 0
+        self.merged = 0
+        self.last_compaction_ms = None
+        self.load()
+        self.open_log()
+
+    def __len__(self):
+        return (sum(s.live() for s in self.segments) + sum(len(batch[1]) for batch in self.sealing)
+                + len(self.active_entries))
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        manifest_path = os.path.join(self.path, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["dim"] != self.dim or manifest["mode"] != self.mode:
+                raise ValueError("Question store at " + self.path + " was written with dim " +
+                                 str(manifest["dim"]) + " and mode " + manifest["mode"])
+            self.next_segment = manifest["next_segment"]
+            codebooks_path = os.path.join(self.path, "codebooks.npy")
+            if self.mode == "pq" and os.path.exists(codebooks_path):
+                self.codebooks = np.load(codebooks_path)
+            self.segments = [Segment(self.path, s["name"], s["mode"], s.get("level", 0), s.get("compacted", False))
+                             for s in manifest["segments"]]
+        self.replay_logs()
+
+    def replay_logs(self):
+        """
+        Seal what was added but not sealed before the last shutdown or crash.
+        An entry whose segment was written but whose log was not removed yet
+        comes back once, the next compaction merges it with its copy.
+        """
+        logs = sorted(f for f in os.listdir(self.path) if f.startswith("log-") and f.endswith(".jsonl"))
+        for log_name in logs:
+            self.next_log = max(self.next_log, int(log_name[4:-6]) + 1)
+            log_path = os.path.join(self.path, log_name)
+            vectors = []
+            entry_lines = []
+            with open(log_path, "rb") as f:
+                for line in f:
+                    try:
+                        logged = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed process may be incomplete
+                        continue
+                    vectors.append(np.frombuffer(base64.b64decode(logged.pop("vector")), dtype=np.float32))
+                    entry_lines.append((json.dumps(logged) + "\n").encode("utf-8"))
+            if not entry_lines:
+                os.remove(log_path)
+                continue
+            print("Replaying " + str(len(entry_lines)) + " question store entries from " + log_name)
+            batch = (np.stack(vectors), entry_lines, log_path)
+            self.sealing.append(batch)
+            self.sealer.submit(self.seal, batch)
+
+    def open_log(self):
+        self.log_path = os.path.join(self.path, "log-{:06d}.jsonl".format(self.next_log))
+        self.next_log += 1
+        self.log = open(self.log_path, "ab")
+
+    def write_manifest(self, segments):
+        manifest = {
+            "dim": self.dim,
+            "mode": self.mode,
+            "next_segment": self.next_segment,
+            "segments": [{"name": s.name, "mode": s.mode, "level": s.level, "compacted": s.compacted}
+                         for s in segments],
+        }
+        tmp_path = os.path.join(self.path, "manifest.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, "manifest.json"))
+
+    def new_segment_name(self):
+        with self.lock:
+            name = "seg-{:06d}".format(self.next_segment)
+            self.next_segment += 1
+        return name
+
+    def array_specs(self, mode, compacted):
+        if mode == "pq":
+            specs = {"codes": (np.uint8, (self.pq_subvectors,)), "full": (np.float32, (self.dim,))}
+        elif mode == "int8":
+            specs = {"codes": (np.int8, (self.dim,)), "scales": (np.float32, ())}
+        else:
+            specs = {"codes": (np.dtype(mode), (self.dim,))}
+        if compacted:
+            specs["lsh"] = (np.int32, (self.lsh_tables,))
+        return specs
+
+    def write_segment(self, mode, count, blocks, level=0, compacted=False):
+        """
+        Write a segment of count entries from blocks of (arrays, entry lines)
+        without holding more than one block in memory.
+        """
+        name = self.new_segment_name()
+        base = os.path.join(self.path, name)
+        outputs = {key: np.lib.format.open_memmap(base + "." + key + ".npy", mode="w+", dtype=dtype,
+                                                  shape=(count,) + shape)
+                   for key, (dtype, shape) in self.array_specs(mode, compacted).items()}
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        row = 0
+        with open(base + ".entries.jsonl", "wb") as f:
+            for arrays, entry_lines in blocks:
+                for key, array in arrays.items():
+                    outputs[key][row:row + len(entry_lines)] = array
+                for line in entry_lines:
+                    f.write(line)
+                    offsets[row + 1] = offsets[row] + len(line)
+                    row += 1
+        for output in outputs.values():
+            output.flush()
+        del outputs
+        np.save(base + ".offsets.npy", offsets)
+        return Segment(self.path, name, mode, level, compacted)
+
+    def add(self, question, answer, vector):
+        vector = normalize(vector)
+        entry = {"question": question, "answer": answer}
+        entry_line = (json.dumps(entry) + "\n").encode("utf-8")
+        logged = dict(entry, vector=base64.b64encode(vector.tobytes()).decode("ascii"))
+        batch = None
+        with self.lock:
+            # the log keeps the entries that are not sealed yet across a crash
+            self.log.write((json.dumps(logged) + "\n").encode("utf-8"))
+            self.log.flush()
+            self.active_vectors.append(vector)
+            self.active_entries.append(entry_line)
+            self.active_matrix = None
+            if len(self.active_entries) >= self.segment_size:
+                batch = self.take_active_locked()
+        if batch is not None:
+            # writing files and training codebooks must not block the caller
+            self.sealer.submit(self.seal, batch)
+
+    def flush(self):
+        """
+        Seal the active segment and wait until every pending segment is on disk.
+        """
+        with self.lock:
+            batch = self.take_active_locked() if self.active_entries else None
+        if batch is not None:
+            self.sealer.submit(self.seal, batch).result()
+        else:
+            self.sealer.submit(lambda: None).result()
+
+    def take_active_locked(self):
+        # the batch stays searchable from memory until its segment is written
+        self.log.close()
+        batch = (np.stack(self.active_vectors), self.active_entries, self.log_path)
+        self.sealing.append(batch)
+        self.active_vectors = []
+        self.active_entries = []
+        self.active_matrix = None
+        self.open_log()
+        return batch
+
+    def seal(self, batch):
+        vectors, entry_lines, log_path = batch
+        try:
+            mode = self.segment_mode(vectors)
+            segment = self.write_segment(mode, len(entry_lines), [(encode(mode, vectors, self.codebooks), entry_lines)])
+            with self.lock:
+                self.write_manifest(self.segments + [segment])
+                self.segments.append(segment)
+                self.sealing = [b for b in self.sealing if b is not batch]
+        except Exception as e:
+            # the batch stays in memory and in its log until a retry succeeds
+            print("Could not seal a question store segment, retrying in {}s: {}".format(seal_retry_seconds, e))
+            retry = threading.Timer(seal_retry_seconds, self.retry_seal, args=(batch,))
+            retry.daemon = True
+            retry.start()
+            return False
+        # the entries are in a segment now, their log is no longer needed
+        os.remove(log_path)
+        return True
+
+    def retry_seal(self, batch):
+        try:
+            self.sealer.submit(self.seal, batch)
+        except RuntimeError:
+            # the store was shut down, the log is replayed on the next start
+            pass
+
+    def segment_mode(self, vectors):
+        if self.mode != "pq":
+            return self.mode
+        self.ensure_codebooks(vectors)
+        return "pq" if self.codebooks is not None else "float16"
+
+    def ensure_codebooks(self, vectors):
+        # too few rows give codebooks with too few centroids, which would then be used forever
+        with self.train_lock:
+            if self.codebooks is not None or len(vectors) < pq_centroids * pq_train_factor:
+                return
+            codebooks = train_codebooks(vectors[:pq_train_sample], self.pq_subvectors)
+            np.save(os.path.join(self.path, "codebooks.npy"), codebooks)
+            self.codebooks = codebooks
+
+    def search(self, vector):
+        """
+        Return (score, entry) of the closest stored question, or None if nothing is above the threshold.
+        """
+        query = normalize(vector)
+        with self.lock:
+            segments = list(self.segments)
+            if self.active_matrix is None and self.active_vectors:
+                self.active_matrix = np.stack(self.active_vectors)
+            in_memory = [(batch[0], batch[1]) for batch in self.sealing]
+            if self.active_matrix is not None:
+                in_memory.append((self.active_matrix, list(self.active_entries)))
+            codebooks = self.codebooks
+
+        table = None
+        if codebooks is not None and any(segment.mode == "pq" for segment in segments):
+            subvectors, _, sub_dim = codebooks.shape
+            table = np.einsum("mkd,md->mk", codebooks, query.reshape(subvectors, sub_dim))
+
+        candidate_scores = []
+        candidate_ids = []
+        for s, segment in enumerate(segments):
+            for start in range(0, len(segment), block_size):
+                scores = segment.scores(query, start, min(start + block_size, len(segment)), table)
+                top = min(self.rerank, len(scores))
+                rows = np.argpartition(-scores, top - 1)[:top]
+                candidate_scores.append(scores[rows])
+                candidate_ids.extend((s, start + int(row)) for row in rows)
+
+        best = None
+        if candidate_ids:
+            candidate_scores = np.concatenate(candidate_scores)
+            top = min(self.rerank, len(candidate_scores))
+            for i in np.argpartition(-candidate_scores, top - 1)[:top]:
+                s, row = candidate_ids[i]
+                score = float(candidate_scores[i])
+                if score == -np.inf:
+                    # replaced by a newer duplicate
+                    continue
+                if segments[s].full is not None:
+                    score = float(segments[s].full[row] @ query)
+                if best is None or score > best[0]:
+                    best = (score, s, row)
+
+        for matrix, entries in in_memory:
+            scores = matrix @ query
+            row = int(np.argmax(scores))
+            if best is None or scores[row] > best[0]:
+                best = (float(scores[row]), entries, row)
+
+        if best is None or best[0] < self.threshold:
+            return None
+        score, source, row = best
+        if isinstance(source, list):
+            return score, json.loads(source[row])
+        return score, segments[source].entry(row)
+
+    def lsh_bits(self, entries):
+        # buckets of about lsh_bucket_size entries, whatever the size of the store
+        bits = int(np.ceil(np.log2(max(entries, 1) / lsh_bucket_size)))
+        return min(lsh_max_bits, max(lsh_min_bits, bits))
+
+    def signatures(self, vectors):
+        bits = (vectors @ self.hyperplanes > 0).reshape(len(vectors), self.lsh_tables, lsh_max_bits)
+        return (bits.astype(np.int32) @ (1 << np.arange(lsh_max_bits, dtype=np.int32))).astype(np.int32)
+
+    def segment_signatures(self, segment):
+        return np.concatenate([self.signatures(segment.vectors(np.arange(start, min(start + block_size, len(segment)))))
+                               for start in range(0, len(segment), block_size)])
+
+    def gather(self, segments, starts, ids):
+        """
+        Vectors of entries numbered consecutively across segments, starts holds
+        the number of the first entry of every segment.
+        """
+        which = np.searchsorted(starts, ids, side="right") - 1
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+        for s in np.unique(which):
+            mask = which == s
+            vectors[mask] = segments[s].vectors(ids[mask] - starts[s])
+        return vectors
+
+    def duplicates(self, query_vectors, query_signatures, shift, index, signatures, segments, starts):
+        """
+        Query positions and ids of the indexed entries they duplicate.
+        """
+        queries, ids = shared_buckets(index, query_signatures >> shift)
+        differing = np.ascontiguousarray(query_signatures[queries] ^ signatures[ids]).view(np.uint8)
+        close = bit_counts[differing].sum(axis=1, dtype=np.int64) <= self.max_differing_bits
+        queries = queries[close]
+        ids = ids[close]
+        if len(ids) == 0:
+            return queries, ids
+        unique, inverse = np.unique(ids, return_inverse=True)
+        vectors = self.gather(segments, starts, unique)
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), block_size):
+            pairs = slice(start, start + block_size)
+            scores[pairs] = np.einsum("ij,ij->i", query_vectors[queries[pairs]], vectors[inverse[pairs]])
+        found = scores >= self.duplicate_threshold
+        return queries[found], ids[found]
+
+    def compact(self):
+        """
+        Deduplicate the segments sealed since the last compaction against each
+        other and against everything compacted before, the newest answer wins,
+        then merge compacted segments in tiers of merge_factor. Each entry is
+        hashed once and older entries are only rewritten when their tier is
+        merged, so a compaction costs about as much as the new entries.
+        """
+        with self.compact_lock:
+            started = time.perf_counter()
+            with self.lock:
+                segments = list(self.segments)
+            if not segments:
+                return 0
+            new = [s for s in segments if not s.compacted]
+            old = [s for s in segments if s.compacted]
+            if self.mode == "pq" and self.codebooks is None:
+                self.ensure_codebooks(self.sample_vectors(new + old))
+            shift = lsh_max_bits - self.lsh_bits(sum(s.live() for s in segments))
+
+            merged = 0
+            result = list(old)
+            if new:
+                new_signatures = [self.segment_signatures(s) for s in new]
+                new_starts = np.cumsum([0] + [len(s) for s in new])[:-1]
+                new_full = np.concatenate(new_signatures)
+                new_count = len(new_full)
+                new_index = lsh_index(new_full >> shift, np.arange(new_count))
+                new_deleted = np.zeros(new_count, dtype=bool)
+
+                old_starts = np.cumsum([0] + [len(s) for s in old])[:-1]
+                old_ids = np.concatenate([start + s.live_rows() for start, s in zip(old_starts, old)]) \
+                    if old else np.empty(0, dtype=np.int64)
+                old_full = np.concatenate([np.asarray(s.signatures) for s in old]) \
+                    if old else np.empty((0, self.lsh_tables), dtype=np.int32)
+                old_index = lsh_index(old_full[old_ids] >> shift, old_ids)
+                old_deleted = []
+
+                for start in range(0, new_count, compact_block):
+                    ids = np.arange(start, min(start + compact_block, new_count))
+                    vectors = self.gather(new, new_starts, ids)
+                    # an entry is replaced by any newer duplicate among the new entries
+                    queries, duplicates = self.duplicates(
+                        vectors, new_full[ids], shift, new_index, new_full, new, new_starts)
+                    newer = duplicates > ids[queries]
+                    new_deleted[ids[queries[newer]]] = True
+                    # and replaces every duplicate that was compacted before
+                    _, duplicates = self.duplicates(
+                        vectors, new_full[ids], shift, old_index, old_full, old, old_starts)
+                    old_deleted.append(duplicates)
+
+                old_deleted = np.unique(np.concatenate(old_deleted)) if old_deleted else np.empty(0, dtype=np.int64)
+                which = np.searchsorted(old_starts, old_deleted, side="right") - 1
+                for s in np.unique(which):
+                    old[s].mark_deleted(old_deleted[which == s] - old_starts[s])
+                merged = int(new_deleted.sum()) + len(old_deleted)
+
+                for s, segment in enumerate(new):
+                    if segment.deleted is None:
+                        segment.deleted = np.zeros(len(segment), dtype=bool)
+                    segment.deleted = segment.deleted | new_deleted[new_starts[s]:new_starts[s] + len(segment)]
+                    segment.deleted_count = int(segment.deleted.sum())
+                compacted = self.rewrite(new, 0, new_signatures)
+                if compacted is not None:
+                    result.append(compacted)
+
+            result, replaced = self.merge_tiers(result)
+            with self.lock:
+                current = result + [s for s in self.segments if s not in segments]
+                self.write_manifest(current)
+                self.segments = current
+            for segment in new + replaced:
+                for file in segment.files():
+                    if os.path.exists(file):
+                        os.remove(file)
+            self.compactions += 1
+            self.merged += merged
+            self.last_compaction_ms = (time.perf_counter() - started) * 1000
+            print("Compacted the question store in {:.0f}ms: merged {} near-duplicates".format(
+                self.last_compaction_ms, merged))
+            return merged
+
+    def merge_tiers(self, segments):
+        """
+        Merge merge_factor compacted segments of the same level into one of the
+        next level, and rewrite segments that are mostly deleted or were
+        written as float16 before the pq codebooks existed.
+        """
+        target_mode = "float16" if self.mode == "pq" and self.codebooks is None else self.mode
+        replaced = []
+        while True:
+            stale = [s for s in segments
+                     if s.mode != target_mode or s.deleted_count > rewrite_deleted_ratio * len(s)]
+            levels = Counter(s.level for s in segments)
+            full_levels = [level for level, count in levels.items() if count >= self.merge_factor]
+            if stale:
+                group = stale[:1]
+                level = group[0].level
+            elif full_levels:
+                group = [s for s in segments if s.level == min(full_levels)][:self.merge_factor]
+                level = group[0].level + 1
+            else:
+                return segments, replaced
+            position = segments.index(group[0])
+            segments = [s for s in segments if s not in group]
+            rewritten = self.rewrite(group, level)
+            if rewritten is not None:
+                segments.insert(position, rewritten)
+            replaced.extend(group)
+
+    def rewrite(self, sources, level, signatures=None):
+        """
+        Write the live entries of the given segments as one compacted segment,
+        or return None if none are left.
+        """
+        mode = "pq" if self.mode == "pq" and self.codebooks is not None else (
+            "float16" if self.mode == "pq" else self.mode)
+        count = sum(s.live() for s in sources)
+        if count == 0:
+            return None
+
+        def blocks():
+            for i, segment in enumerate(sources):
+                rows = segment.live_rows()
+                for start in range(0, len(rows), block_size):
+                    chunk = rows[start:start + block_size]
+                    if segment.mode == mode:
+                        arrays = segment.arrays(chunk)
+                    else:
+                        arrays = encode(mode, segment.vectors(chunk), self.codebooks)
+                    arrays["lsh"] = (signatures[i] if signatures is not None else segment.signatures)[chunk]
+                    yield arrays, list(segment.entry_bytes(chunk))
+
+        return self.write_segment(mode, count, blocks(), level, compacted=True)
+
+    def sample_vectors(self, segments):
+        vectors = []
+        remaining = pq_train_sample
+        for segment in segments:
+            rows = segment.live_rows()[:remaining]
+            if len(rows):
+                vectors.append(segment.vectors(rows))
+                remaining -= len(rows)
+        return np.concatenate(vectors) if vectors else np.empty((0, self.dim), dtype=np.float32)
+
+    def compact_in_background(self):
+        if self.compact_lock.locked():
+            return
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            segments = list(self.segments)
+            active = len(self.active_entries) + sum(len(batch[1]) for batch in self.sealing)
+        stored = sum(len(s) for s in segments)
+        live = sum(s.live() for s in segments)
+        resident = sum(s.nbytes() for s in segments)
+        disk = sum(s.disk_bytes() for s in segments)
+        if self.codebooks is not None:
+            resident += self.codebooks.nbytes
+            disk += self.codebooks.nbytes
+        return {
+            "mode": self.mode,
+            "entries": live + active,
+            "segments": len(segments),
+            "levels": dict(Counter(s.level for s in segments if s.compacted)),
+            "activeEntries": active,
+            "deletedEntries": stored - live,
+            "bytesPerEntry": resident / stored if stored else None,
+            "diskBytesPerEntry": disk / stored if stored else None,
+            "lshBits": self.lsh_bits(live),
+            "compactions": self.compactions,
+            "merged": self.merged,
+            "lastCompactionMs": self.last_compaction_ms,
+        }
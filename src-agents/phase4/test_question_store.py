@@ -0,0 +1,223 @@
+import os
+import time
+import numpy as np
+import pytest
+import question_store
+from question_store import QuestionStore, normalize, pq_centroids, pq_train_factor
+
+dim = 64
+
+
+def random_vectors(count, seed=0):
+    return normalize(np.random.default_rng(seed).normal(size=(count, dim)))
+
+
+def fill(store, vectors, prefix="q"):
+    for i, vector in enumerate(vectors):
+        store.add("{} {}".format(prefix, i), "{} {}".format(prefix, i), vector)
+
+
+@pytest.mark.parametrize("mode", ["float32", "float16", "int8"])
+def test_quantized_segments_find_the_stored_question(tmp_path, mode):
+    vectors = random_vectors(300)
+    store = QuestionStore(str(tmp_path), dim, mode=mode, segment_size=100, threshold=0.9)
+    fill(store, vectors)
+    store.flush()
+
+    assert len(store.segments) == 3
+    assert all(segment.mode == mode for segment in store.segments)
+    for i in [0, 150, 299]:
+        score, entry = store.search(vectors[i])
+        assert entry["answer"] == "q {}".format(i)
+        assert score == pytest.approx(1, abs=0.02)
+
+
+def test_search_misses_below_the_threshold(tmp_path):
+    store = QuestionStore(str(tmp_path), dim, segment_size=10, threshold=0.9)
+    fill(store, random_vectors(20))
+    store.flush()
+    assert store.search(random_vectors(1, seed=1)[0]) is None
+
+
+def test_unsealed_entries_are_found(tmp_path):
+    vectors = random_vectors(15)
+    store = QuestionStore(str(tmp_path), dim, segment_size=10)
+    fill(store, vectors)
+
+    assert store.search(vectors[12])[1]["answer"] == "q 12"
+    store.flush()
+    assert len(store) == 15
+    assert store.stats()["activeEntries"] == 0
+
+
+def test_reload_from_manifest(tmp_path):
+    vectors = random_vectors(250)
+    store = QuestionStore(str(tmp_path), dim, segment_size=100)
+    fill(store, vectors)
+    store.flush()
+
+    reloaded = QuestionStore(str(tmp_path), dim, segment_size=100)
+    assert len(reloaded) == 250
+    assert [s.name for s in reloaded.segments] == [s.name for s in store.segments]
+    assert reloaded.search(vectors[201])[1]["answer"] == "q 201"
+
+    # new segments must not overwrite the ones that were loaded
+    fill(reloaded, random_vectors(100, seed=2), prefix="new")
+    reloaded.flush()
+    assert len(set(s.name for s in reloaded.segments)) == len(reloaded.segments)
+    assert reloaded.search(vectors[0])[1]["answer"] == "q 0"
+
+
+def test_reload_refuses_a_different_mode(tmp_path):
+    store = QuestionStore(str(tmp_path), dim, mode="int8")
+    fill(store, random_vectors(5))
+    store.flush()
+    with pytest.raises(ValueError):
+        QuestionStore(str(tmp_path), dim, mode="float16")
+
+
+def test_compaction_keeps_the_newest_answer(tmp_path):
+    vectors = random_vectors(50)
+    store = QuestionStore(str(tmp_path), dim, segment_size=20)
+    fill(store, vectors, prefix="old")
+    store.flush()
+    # the same questions again later on, with new answers
+    fill(store, vectors[:10], prefix="new")
+    store.flush()
+    old_files = [f for segment in store.segments for f in segment.files()]
+
+    assert store.compact() == 10
+    assert len(store) == 50
+    for i in range(10):
+        assert store.search(vectors[i])[1]["answer"] == "new {}".format(i)
+    assert store.search(vectors[30])[1]["answer"] == "old 30"
+    assert not any((tmp_path / f).exists() for f in old_files)
+
+    reloaded = QuestionStore(str(tmp_path), dim, segment_size=20)
+    assert len(reloaded) == 50
+    assert reloaded.search(vectors[3])[1]["answer"] == "new 3"
+
+
+def test_pq_waits_for_enough_rows_to_train(tmp_path):
+    train_rows = pq_centroids * pq_train_factor
+    vectors = random_vectors(train_rows + 100)
+    store = QuestionStore(str(tmp_path), dim, mode="pq", segment_size=100, pq_subvectors=8)
+
+    # a small first flush must not train codebooks on a handful of rows
+    fill(store, vectors[:100])
+    store.flush()
+    assert store.codebooks is None
+    assert store.segments[0].mode == "float16"
+    assert store.search(vectors[42])[1]["answer"] == "q 42"
+
+    # compaction trains once there is enough data and converts the float16 segments
+    for i, vector in enumerate(vectors[100:]):
+        store.add("q {}".format(100 + i), "q {}".format(100 + i), vector)
+    store.flush()
+    store.compact()
+    assert store.codebooks is not None
+    assert store.codebooks.shape == (8, pq_centroids, dim // 8)
+    assert all(segment.mode == "pq" for segment in store.segments)
+
+    found = [store.search(vectors[i])[1]["answer"] for i in range(0, len(vectors), 37)]
+    assert found == ["q {}".format(i) for i in range(0, len(vectors), 37)]
+
+    reloaded = QuestionStore(str(tmp_path), dim, mode="pq", segment_size=100, pq_subvectors=8)
+    assert reloaded.search(vectors[7])[1]["answer"] == "q 7"
+
+
+def test_pq_trains_on_a_full_segment(tmp_path):
+    vectors = random_vectors(pq_centroids * pq_train_factor)
+    store = QuestionStore(str(tmp_path), dim, mode="pq", segment_size=len(vectors), pq_subvectors=8)
+    fill(store, vectors)
+    store.flush()
+    assert store.segments[0].mode == "pq"
+    assert store.search(vectors[5])[1]["answer"] == "q 5"
+
+
+def test_stats_report_resident_and_disk_bytes(tmp_path):
+    store = QuestionStore(str(tmp_path), dim, mode="int8", segment_size=100)
+    fill(store, random_vectors(100))
+    store.flush()
+    stats = store.stats()
+    assert stats["entries"] == 100
+    # int8 codes, a scale and an offset per entry
+    assert stats["bytesPerEntry"] == pytest.approx(dim + 4 + 8, abs=1)
+    assert stats["diskBytesPerEntry"] > stats["bytesPerEntry"]
+
+
+def test_unsealed_entries_survive_a_crash(tmp_path):
+    vectors = random_vectors(30)
+    store = QuestionStore(str(tmp_path), dim, segment_size=100)
+    fill(store, vectors)
+    # no flush: the process dies with everything in the active segment
+
+    reloaded = QuestionStore(str(tmp_path), dim, segment_size=100)
+    assert reloaded.search(vectors[17])[1]["answer"] == "q 17"
+    reloaded.flush()
+    assert len(reloaded) == 30
+    assert len(reloaded.segments) == 1
+    assert not any(f.startswith("log-") and (tmp_path / f).stat().st_size for f in os.listdir(tmp_path))
+
+
+def test_failed_seal_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(question_store, "seal_retry_seconds", 0.01)
+    vectors = random_vectors(20)
+    store = QuestionStore(str(tmp_path), dim, segment_size=10)
+    write_segment = store.write_segment
+    failures = []
+
+    def failing_once(*args, **kwargs):
+        if not failures:
+            failures.append(1)
+            raise OSError("disk full")
+        return write_segment(*args, **kwargs)
+
+    store.write_segment = failing_once
+    fill(store, vectors[:10])
+    store.flush()
+    # still searchable while the retry is pending
+    assert store.search(vectors[3])[1]["answer"] == "q 3"
+    for _ in range(100):
+        if store.segments:
+            break
+        time.sleep(0.01)
+    store.flush()
+    assert len(store.segments) == 1
+    assert len(store) == 10
+
+
+def test_compaction_only_rewrites_new_segments(tmp_path):
+    vectors = random_vectors(100)
+    store = QuestionStore(str(tmp_path), dim, segment_size=50, merge_factor=4)
+    fill(store, vectors, prefix="old")
+    store.flush()
+    store.compact()
+    assert [s.compacted for s in store.segments] == [True]
+    compacted = store.segments[0]
+
+    fill(store, vectors[:5], prefix="new")
+    fill(store, random_vectors(45, seed=3), prefix="other")
+    store.flush()
+    assert store.compact() == 5
+
+    # the old segment is kept with its replaced entries marked, not rewritten
+    assert store.segments[0] is compacted
+    assert compacted.deleted_count == 5
+    assert len(store) == 145
+    assert store.search(vectors[2])[1]["answer"] == "new 2"
+
+    reloaded = QuestionStore(str(tmp_path), dim, segment_size=50, merge_factor=4)
+    assert len(reloaded) == 145
+    assert reloaded.search(vectors[2])[1]["answer"] == "new 2"
+
+
+def test_compacted_segments_merge_in_tiers(tmp_path):
+    store = QuestionStore(str(tmp_path), dim, segment_size=20, merge_factor=2)
+    for i in range(4):
+        fill(store, random_vectors(20, seed=10 + i), prefix="batch{}".format(i))
+        store.flush()
+        store.compact()
+    assert len(store) == 80
+    assert [s.level for s in store.segments] == [2]
+    assert store.search(random_vectors(20, seed=12)[7])[1]["answer"] == "batch2 7"
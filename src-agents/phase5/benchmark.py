@@ -0,0 +1,105 @@
+"""
+Replays a question log against the phase5 planner and against fixed plans that
+mimic the strategies of phase1 to phase4, and prints accuracy, latency and tokens.
+
+    python benchmark.py [questions.jsonl] [rounds]
+
+Each line of the log is an Ask with the expected answer, e.g.
+{"question": "...", "type": "multiple_choice", "answer": "..."}
+"""
+import sys
+import json
+import time
+import asyncio
+from main import Ask, warm_state, planner, ledger, client, embedding_model, answer_for_warmup
+from warmup import AnswerCache, normalize_question
+
+strategies = {
+    "phase1": [["llm"]],
+    "phase2": [["rag"]],
+    "phase3": [["tools"]],
+    "phase4": [["cache"], ["llm"]],
+    "phase5": None,
+}
+
+
+def is_correct(expected, actual):
+    expected = normalize_question(str(expected))
+    actual = normalize_question(actual or "")
+    return expected == actual or expected in actual
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_strategy(name, stages, questions, rounds):
+    # every strategy starts with an empty answer cache, it can only hit on repeated questions
+    warm_state.answers = AnswerCache()
+    if stages is None:
+        # the planner starts from its priors, not from what the fixed plans taught it
+        planner.reset()
+    latencies = []
+    tokens = 0
+    correct = 0
+    for round in range(rounds):
+        for i, question in enumerate(questions):
+            ask = Ask(question=question["question"], type=question["type"],
+                      correlationToken="{}-{}-{}".format(name, round, i))
+            request = ledger.start(ask.type.value, ask.correlationToken)
+            start = time.perf_counter()
+            if stages is None:
+                result, decision = await planner.answer(ask)
+            else:
+                result, decision = await planner.answer(ask, stages=stages, budget=float("inf"))
+            latencies.append((time.perf_counter() - start) * 1000)
+            # parallel paths that lost still cost tokens, wait for them before counting
+            await planner.drain()
+            ledger.finish(request, result is not None)
+            tokens += request.total.tokens()
+            if result is None:
+                continue
+            if decision["chosen"] != "cache":
+                warm_state.answers.put(ask.question, ask.type.value, result.answer)
+            answered_correctly = is_correct(question["answer"], result.answer)
+            correct += answered_correctly
+            # fixed plans teach the planner the accuracy of their paths as well
+            planner.record_feedback(ask.correlationToken, answered_correctly)
+    total = len(latencies)
+    return {
+        "strategy": name,
+        "questions": total,
+        "accuracy": correct / total if total else 0,
+        "meanMs": sum(latencies) / total if total else 0,
+        "p95Ms": percentile(latencies, 0.95),
+        "tokensPerAnswer": tokens / total if total else 0,
+    }
+
+
+async def main(path, rounds):
+    with open(path) as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    questions = [q for q in questions if q.get("question") and q.get("answer")]
+
+    warm_state.run(client, embedding_model, answer_for_warmup)
+
+    results = []
+    for name, stages in strategies.items():
+        results.append(await run_strategy(name, stages, questions, rounds))
+
+    print("{:<8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "strategy", "questions", "accuracy", "mean ms", "p95 ms", "tokens"))
+    for r in results:
+        print("{:<8} {:>9} {:>9.3f} {:>9.0f} {:>9.0f} {:>9.0f}".format(
+            r["strategy"], r["questions"], r["accuracy"], r["meanMs"], r["p95Ms"], r["tokensPerAnswer"]))
+    print("tokens count every path a plan started, phase5 started from the planner's priors")
+    print(json.dumps(planner.report()["stats"], indent=2))
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "questions.jsonl"
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    asyncio.run(main(path, rounds))
@@ -0,0 +1,247 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+
+# token budgets, 0 switches a budget off
+request_token_budget = int(os.getenv("TOKEN_BUDGET_PER_REQUEST", "8000"))
+minute_token_budget = int(os.getenv("TOKEN_BUDGET_PER_MINUTE", "300000"))
+# prices in the currency of your choice per 1000 tokens, used for the cost per answer
+prompt_token_price = float(os.getenv("COST_PER_1K_PROMPT_TOKENS", "0.0025"))
+completion_token_price = float(os.getenv("COST_PER_1K_COMPLETION_TOKENS", "0.01"))
+
+# the ledger of the request being answered, asyncio.to_thread carries it into the planner paths
+current_request = contextvars.ContextVar("current_request", default=None)
+
+encoding = None
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def count_tokens(text):
+    global encoding
+    if encoding is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # roughly four characters per token if the tokenizer is not available
+            encoding = False
+    if not encoding:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def estimate_prompt_tokens(kwargs):
+    if "messages" in kwargs:
+        texts = [(m.get("content") or "") if isinstance(m, dict) else (m.content or "") for m in kwargs["messages"]]
+        # every message carries a few tokens of overhead for its role
+        return sum(count_tokens(t) + 4 for t in texts)
+    return sum(count_tokens(t) for t in kwargs.get("input", []))
+
+
+class Usage:
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.answers = 0
+
+    def add(self, prompt_tokens, completion_tokens, seconds):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.calls += 1
+        self.seconds += seconds
+
+    def tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def cost(self):
+        return (self.prompt_tokens * prompt_token_price + self.completion_tokens * completion_token_price) / 1000
+
+    def as_dict(self, answers=None):
+        """
+        Totals, plus the share per answer given the number of answers they were spent on.
+        """
+        answers = self.answers if answers is None else answers
+        usage = {
+            "promptTokens": self.prompt_tokens,
+            "completionTokens": self.completion_tokens,
+            "upstreamCalls": self.calls,
+            "upstreamMs": round(self.seconds * 1000, 1),
+            "cost": round(self.cost(), 6),
+        }
+        if answers:
+            usage["answers"] = answers
+            usage["tokensPerAnswer"] = round(self.tokens() / answers, 1)
+            usage["callsPerAnswer"] = round(self.calls / answers, 2)
+            usage["msPerAnswer"] = round(self.seconds * 1000 / answers, 1)
+            usage["costPerAnswer"] = round(self.cost() / answers, 6)
+        return usage
+
+
+class RequestLedger:
+    """
+    Tokens, upstream calls and time spent on one request, per stage.
+    """
+
+    def __init__(self, ledger, question_type, correlation_token):
+        self.ledger = ledger
+        self.question_type = question_type
+        self.correlation_token = correlation_token
+        self.started = time.perf_counter()
+        self.total = Usage()
+        self.stages = {}
+        # estimated tokens of calls that are still running, parallel paths must not overbook the budget
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def check(self, stage, estimated_tokens):
+        """
+        Reserve the estimated tokens of a call or raise BudgetExceeded.
+        """
+        with self.lock:
+            used = self.total.tokens() + self.reserved
+            over = request_token_budget and used + estimated_tokens > request_token_budget
+            if not over:
+                self.reserved += estimated_tokens
+        if over:
+            self.ledger.cut_off(stage)
+            raise BudgetExceeded("{} would use {} tokens on top of {}, over the request budget of {}".format(
+                stage, estimated_tokens, used, request_token_budget))
+        try:
+            self.ledger.check_minute(stage, estimated_tokens)
+        except BudgetExceeded:
+            self.release(estimated_tokens, minute=False)
+            raise
+
+    def release(self, estimated_tokens, minute=True):
+        with self.lock:
+            self.reserved -= estimated_tokens
+        if minute:
+            self.ledger.release_minute(estimated_tokens)
+
+    def record(self, stage, prompt_tokens, completion_tokens, seconds, estimated_tokens=0):
+        with self.lock:
+            self.reserved -= estimated_tokens
+            self.total.add(prompt_tokens, completion_tokens, seconds)
+            self.stages.setdefault(stage, Usage()).add(prompt_tokens, completion_tokens, seconds)
+        self.ledger.record(stage, self.question_type, prompt_tokens, completion_tokens, seconds, estimated_tokens)
+
+    def wall_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+
+class Ledger:
+    """
+    Aggregated token and cost accounting of the service, with a sliding
+    one-minute token budget shared by all requests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.minute = deque()
+        self.minute_tokens = 0
+        self.minute_reserved = 0
+        self.by_type = {}
+        self.by_stage = {}
+        self.wall_seconds = {}
+        self.cutoffs = {}
+
+    def start(self, question_type, correlation_token):
+        request = RequestLedger(self, question_type, correlation_token)
+        current_request.set(request)
+        return request
+
+    def finish(self, request, answered):
+        with self.lock:
+            usage = self.by_type.setdefault(request.question_type, Usage())
+            usage.answers += 1 if answered else 0
+            self.wall_seconds[request.question_type] = self.wall_seconds.get(request.question_type, 0) + request.wall_ms() / 1000
+        print("Request {} used {} tokens in {} upstream calls".format(
+            request.correlation_token, request.total.tokens(), request.total.calls))
+
+    def expire_minute(self, now):
+        while self.minute and now - self.minute[0][0] > 60:
+            self.minute_tokens -= self.minute.popleft()[1]
+
+    def check_minute(self, stage, estimated_tokens):
+        with self.lock:
+            self.expire_minute(time.monotonic())
+            over = minute_token_budget and (
+                self.minute_tokens + self.minute_reserved + estimated_tokens > minute_token_budget)
+            if not over:
+                self.minute_reserved += estimated_tokens
+        if over:
+            self.cut_off(stage)
+            raise BudgetExceeded("{} would use {} tokens, over the budget of {} tokens per minute".format(
+                stage, estimated_tokens, minute_token_budget))
+
+    def release_minute(self, estimated_tokens):
+        with self.lock:
+            self.minute_reserved -= estimated_tokens
+
+    def cut_off(self, stage):
+        with self.lock:
+            self.cutoffs[stage] = self.cutoffs.get(stage, 0) + 1
+
+    def record(self, stage, question_type, prompt_tokens, completion_tokens, seconds, estimated_tokens=0):
+        now = time.monotonic()
+        with self.lock:
+            self.minute_reserved -= estimated_tokens
+            self.minute.append((now, prompt_tokens + completion_tokens))
+            self.minute_tokens += prompt_tokens + completion_tokens
+            self.expire_minute(now)
+            self.by_type.setdefault(question_type, Usage()).add(prompt_tokens, completion_tokens, seconds)
+            self.by_stage.setdefault(stage, {}).setdefault(question_type, Usage()).add(
+                prompt_tokens, completion_tokens, seconds)
+
+    def report(self):
+        with self.lock:
+            by_type = {}
+            for question_type, usage in self.by_type.items():
+                by_type[question_type] = usage.as_dict()
+                if usage.answers:
+                    by_type[question_type]["wallMsPerAnswer"] = round(
+                        self.wall_seconds.get(question_type, 0) * 1000 / usage.answers, 1)
+            return {
+                "budgets": {
+                    "tokensPerRequest": request_token_budget,
+                    "tokensPerMinute": minute_token_budget,
+                },
+                "lastMinuteTokens": self.minute_tokens,
+                "reservedTokens": self.minute_reserved,
+                "cutoffs": dict(self.cutoffs),
+                "byQuestionType": by_type,
+                # what each stage adds to the cost of an answer of that question type
+                "byStage": {stage: {t: u.as_dict(self.by_type[t].answers) for t, u in usage.items()}
+                            for stage, usage in self.by_stage.items()},
+            }
+
+
+def call(stage, create, **kwargs):
+    """
+    Make an upstream OpenAI call on behalf of the current request: refuse it
+    if it would break a token budget, otherwise reserve its estimated tokens
+    and replace them with its actual usage and time once it returns.
+    """
+    request = current_request.get()
+    if request is None:
+        return create(**kwargs)
+    estimated_tokens = estimate_prompt_tokens(kwargs) + (kwargs.get("max_tokens") or 0)
+    request.check(stage, estimated_tokens)
+    start = time.perf_counter()
+    try:
+        response = create(**kwargs)
+    except Exception:
+        request.release(estimated_tokens)
+        raise
+    seconds = time.perf_counter() - start
+    usage = response.usage
+    request.record(stage, usage.prompt_tokens, getattr(usage, "completion_tokens", 0) or 0, seconds,
+                   estimated_tokens)
+    return response
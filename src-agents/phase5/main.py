@@ -1,12 +1,20 @@
 import os
+import hmac
 import json
 import requests
+import threading
 from dotenv import load_dotenv
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse, FileResponse
+from pydantic import BaseModel, Field
 from enum import Enum
 from openai import AzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from warmup import WarmState
+from planner import Planner, budget_ms, overrun_ms
+from profiling import Profiler
+from ledger import Ledger
+import paths
 
 app = FastAPI()
 
@@ -29,13 +37,27 @@ class Answer(BaseModel):
     promptTokensUsed: int | None = None
     completionTokensUsed: int | None = None
 
+class Feedback(BaseModel):
+    correlationToken: str
+    correct: bool
+
+class ProfileRequest(BaseModel):
+    requests: int | None = Field(default=None, gt=0)
+    seconds: float | None = Field(default=None, gt=0)
+    intervalMs: float = Field(default=5, gt=0)
+
 client: AzureOpenAI
 
+# no upstream call may outlive the planner's latency budget plus its overrun
+openai_timeout = (budget_ms + overrun_ms) / 1000
+
 if "AZURE_OPENAI_API_KEY" in os.environ:
     client = AzureOpenAI(
         api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
         api_version = os.getenv("AZURE_OPENAI_VERSION"),
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"),
+        timeout = openai_timeout,
+        max_retries = 1,
     )
 else:
     token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
@@ -43,33 +65,144 @@ else:
         azure_ad_token_provider=token_provider,
         api_version = os.getenv("AZURE_OPENAI_VERSION"),
         azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"),
+        timeout = openai_timeout,
+        max_retries = 1,
     )
 
 deployment_name = os.getenv("AZURE_OPENAI_COMPLETION_DEPLOYMENT_NAME")
 index_name = "movies-semantic-index"
 service_endpoint = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
 model_name = os.getenv("AZURE_OPENAI_COMPLETION_MODEL")
+embedding_model = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL")
+
+warm_state = WarmState()
+profiler = Profiler()
+ledger = Ledger()
+
+# the admin endpoints are only available when a token is configured
+admin_token = os.getenv("ADMIN_TOKEN")
+
+def check_admin(token):
+    if not admin_token:
+        raise HTTPException(status_code=404)
+    # constant time, the comparison must not tell how much of a guess was right
+    if token is None or not hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403)
+
+def answer_for_warmup(question):
+    # used by the warm-up to precompute answers for hot questions from the log
+    ask = Ask(question=question["question"], type=question["type"])
+    return paths.llm_path(client, deployment_name, ask).answer
+
+planner = Planner({
+    "cache": lambda ask: paths.cache_path(warm_state, ask),
+    "facts": lambda ask: paths.facts_path(client, deployment_name, warm_state, ask),
+    "rag": lambda ask: paths.rag_path(client, deployment_name, embedding_model, warm_state, ask),
+    "tools": lambda ask: paths.tools_path(client, deployment_name, warm_state, ask),
+    "llm": lambda ask: paths.llm_path(client, deployment_name, ask),
+})
+
+@app.on_event("startup")
+async def start_warmup():
+    # warm up in the background so /healthz can report progress while we are not ready yet
+    threading.Thread(target=warm_state.run, args=(client, embedding_model, answer_for_warmup), daemon=True).start()
 
 @app.get("/")
 async def root():
     return {"message": "Hello Smorgs"}
 
+@app.get("/healthz", summary="Health check", operation_id="healthz")
+async def healthz(query: str | None = None):
+    """
+    Returns a status of the app
+    """
+    status = warm_state.status()
+    if not warm_state.ready:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
 @app.post("/ask", summary="Ask a question", operation_id="ask") 
 async def ask_question(ask: Ask):
     """
     Ask a question
     """
 
-    start_phrase =  ask.question
-    response: openai.types.chat.chat_completion.ChatCompletion = None
+    request = ledger.start(ask.type.value, ask.correlationToken)
+    result, decision = await planner.answer(ask)
+    ledger.finish(request, result is not None)
+    if profiler.active:
+        profiler.request_finished()
+    if result is None:
+        answer = Answer(answer="")
+        answer.correlationToken = ask.correlationToken
+        answer.promptTokensUsed = request.total.prompt_tokens
+        answer.completionTokensUsed = request.total.completion_tokens
+        return answer
 
-    #####\n",
-    # implement flow here\n",
-    ######\n",
+    if decision["chosen"] != "cache":
+        warm_state.answers.put(ask.question, ask.type.value, result.answer)
 
-    answer = Answer(answer=response.choices[0].message.content)
+    answer = Answer(answer=result.answer)
     answer.correlationToken = ask.correlationToken
-    answer.promptTokensUsed = response.usage.prompt_tokens
-    answer.completionTokensUsed = response.usage.completion_tokens
+    # every call of the request that finished before the answer, paths that lost the race and are
+    # still running are charged to /costs and the budgets when they return, but not to this answer
+    answer.promptTokensUsed = request.total.prompt_tokens
+    answer.completionTokensUsed = request.total.completion_tokens
 
     return answer
+
+@app.get("/planner", summary="Planner statistics and recent decisions", operation_id="planner")
+async def planner_report():
+    """
+    Learned per-path statistics and the most recent planner decisions with their timings
+    """
+    return planner.report()
+
+@app.get("/costs", summary="Token usage and cost per answer", operation_id="costs")
+async def costs():
+    """
+    Tokens, upstream calls and cost per answer by question type and by stage, and the token budgets
+    """
+    return ledger.report()
+
+@app.post("/planner/feedback", summary="Tell the planner whether an answer was correct", operation_id="planner_feedback")
+async def planner_feedback(feedback: Feedback):
+    """
+    Tell the planner whether an answer was correct
+    """
+    decision = planner.record_feedback(feedback.correlationToken, feedback.correct)
+    if decision is not None and not feedback.correct:
+        # never serve a known wrong answer from the cache again
+        warm_state.answers.remove(decision["question"], decision["type"])
+    return {"recorded": decision is not None}
+
+@app.post("/admin/profile", summary="Profile the next requests or a time window", operation_id="start_profile")
+async def start_profile(profile: ProfileRequest, x_admin_token: str | None = Header(default=None)):
+    """
+    Sample the stacks of all threads for the next N requests and/or a number of seconds
+    """
+    check_admin(x_admin_token)
+    if profile.requests is None and profile.seconds is None:
+        raise HTTPException(status_code=422, detail="Set requests and/or seconds")
+    if not profiler.start(profile.requests, profile.seconds, profile.intervalMs):
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+    return profiler.status()
+
+@app.get("/admin/profile", summary="Profiling status and the last result", operation_id="profile_status")
+async def profile_status(x_admin_token: str | None = Header(default=None)):
+    """
+    Profiling status and the summary of the last profile
+    """
+    check_admin(x_admin_token)
+    return profiler.status()
+
+@app.get("/admin/profile/collapsed", summary="Collapsed stacks of the last profile", operation_id="profile_collapsed")
+async def profile_collapsed(x_admin_token: str | None = Header(default=None)):
+    """
+    Download the collapsed-stack file of the last profile, e.g. for flamegraph.pl or speedscope
+    """
+    check_admin(x_admin_token)
+    result = profiler.last_result
+    if result is None or not os.path.exists(result["file"]):
+        raise HTTPException(status_code=404, detail="No profile has been written yet")
+    return FileResponse(result["file"], media_type="text/plain", filename=os.path.basename(result["file"]))
@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+import ledger
+from tools import functions, available_functions, get_movie_fact
+from warmup import normalize_vector, movie_as_text
+
+# tool calls beyond this in one answer are refused instead of executed
+max_tool_calls = int(os.getenv("MAX_TOOL_CALLS", "5"))
+# upper bound of the completion of every chat call, it is reserved against the token budgets before the call
+max_completion_tokens = int(os.getenv("MAX_COMPLETION_TOKENS", "300"))
+
+
+class PathResult:
+    """
+    The answer of one path together with the tokens it spent on the way.
+    """
+
+    def __init__(self, answer, prompt_tokens=0, completion_tokens=0, upstream_calls=0):
+        self.answer = answer
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.upstream_calls = upstream_calls
+
+    def add_usage(self, response):
+        self.prompt_tokens += response.usage.prompt_tokens
+        self.completion_tokens += getattr(response.usage, "completion_tokens", 0) or 0
+        self.upstream_calls += 1
+
+
+def system_prompt_for(question_type):
+    if question_type == "multiple_choice":
+        system_prompt = "Please choose the correct option:"
+    elif question_type == "true_or_false":
+        system_prompt = "Is the following statement true or false: answer in true or false in lower case without \".\""
+    elif question_type == "popular_choice":
+        system_prompt = "What is the most popular choice for:"
+    elif question_type == "estimation":
+        system_prompt = "Please estimate the value of: Answer only in numbers."
+    else:
+        system_prompt = "Here is what you need to do:"
+    return "Answer this question with exact content only. Option number is not required. Answer will be used as such for verification. Numbers can also be used. Avoid unnecessary literals. " + system_prompt
+
+
+def cache_path(warm_state, ask):
+    answer = warm_state.answers.get(ask.question, ask.type.value)
+    if answer is None:
+        return None
+    return PathResult(answer)
+
+
+fact_keywords = {
+    "rating": ["rating", "rated", "score"],
+    "year": ["year", "released", "release", "when"],
+    "actor": ["actor", "actors", "actress", "starring", "star", "who"],
+    "location": ["location", "where", "filmed", "country", "place", "city"],
+    "genre": ["genre"],
+}
+
+
+def find_title(question, titles):
+    question = question.lower()
+    found = [title for title in titles if title.lower() in question]
+    return max(found, key=len) if found else None
+
+
+def facts_path(client, deployment_name, warm_state, ask):
+    title = find_title(ask.question, warm_state.facts.keys())
+    if title is None:
+        return None
+    words = set(w.strip("?,.!:;\"'()") for w in ask.question.lower().split())
+    kinds = [kind for kind, keywords in fact_keywords.items()
+             if kind in warm_state.facts[title] and words.intersection(keywords)]
+    if not kinds:
+        return None
+
+    # a single numeric fact answers an estimation without asking the llm
+    if ask.type.value == "estimation" and len(kinds) == 1 and kinds[0] in ["year", "rating"]:
+        return PathResult(warm_state.facts[title][kinds[0]].strip())
+
+    facts_as_text = " ".join("The {} of {} is {}.".format(kind, title, warm_state.facts[title][kind])
+                             for kind in kinds)
+    result = PathResult(None)
+    response = ledger.call(
+        "facts.completion", client.chat.completions.create,
+        model=deployment_name,
+        max_tokens=max_completion_tokens,
+        messages=[{"role": "system", "content": system_prompt_for(ask.type.value) + " Facts: " + facts_as_text},
+                  {"role": "user", "content": ask.question}],
+    )
+    result.add_usage(response)
+    result.answer = response.choices[0].message.content
+    return result
+
+
+def rag_path(client, deployment_name, embedding_model, warm_state, ask, top=5):
+    if not warm_state.movies:
+        return None
+    result = PathResult(None)
+    embedding_response = ledger.call(
+        "rag.embedding", client.embeddings.create, input=[ask.question], model=embedding_model)
+    result.add_usage(embedding_response)
+    vector = normalize_vector(embedding_response.data[0].embedding)
+
+    scores = warm_state.movie_vectors @ vector
+    found_movies = [warm_state.movies[i] for i in np.argsort(-scores)[:top]]
+    found_docs_as_text = " ".join(movie_as_text(m) for m in found_movies)
+
+    response = ledger.call(
+        "rag.completion", client.chat.completions.create,
+        model=deployment_name,
+        max_tokens=max_completion_tokens,
+        messages=[{"role": "system", "content": system_prompt_for(ask.type.value) + " Context: " + found_docs_as_text},
+                  {"role": "user", "content": ask.question}],
+    )
+    result.add_usage(response)
+    result.answer = response.choices[0].message.content
+    return result
+
+
+def tools_path(client, deployment_name, warm_state, ask):
+    result = PathResult(None)
+    messages = [{"role": "system", "content": system_prompt_for(ask.type.value) + " Use the tools available to you."},
+                {"role": "user", "content": ask.question}]
+    first_response = ledger.call(
+        "tools.select", client.chat.completions.create,
+        model=deployment_name,
+        max_tokens=max_completion_tokens,
+        messages=messages,
+        tools=functions,
+        tool_choice="auto",
+    )
+    result.add_usage(first_response)
+    response_message = first_response.choices[0].message
+    tool_calls = response_message.tool_calls
+    if not tool_calls:
+        result.answer = response_message.content
+        return result
+
+    messages.append(response_message)
+    for i, tool_call in enumerate(tool_calls):
+        function_name = tool_call.function.name
+        if i >= max_tool_calls:
+            function_response = "Tool call limit reached"
+        elif function_name not in available_functions:
+            function_response = "Function " + function_name + " does not exist"
+        else:
+            function_args = json.loads(tool_call.function.arguments)
+            function_response = get_movie_fact(
+                available_functions[function_name], function_args.get("title", ""), warm_state.facts)
+        messages.append(
+            {
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": function_name,
+                "content": function_response,
+            }
+        )
+
+    # one more round trip for all tool results together
+    second_response = ledger.call(
+        "tools.answer", client.chat.completions.create,
+        model=deployment_name,
+        max_tokens=max_completion_tokens,
+        messages=messages,
+    )
+    result.add_usage(second_response)
+    result.answer = second_response.choices[0].message.content
+    return result
+
+
+def llm_path(client, deployment_name, ask):
+    result = PathResult(None)
+    response = ledger.call(
+        "llm.completion", client.chat.completions.create,
+        model=deployment_name,
+        max_tokens=max_completion_tokens,
+        messages=[{"role": "system", "content": system_prompt_for(ask.type.value)},
+                  {"role": "user", "content": ask.question}],
+    )
+    result.add_usage(response)
+    result.answer = response.choices[0].message.content
+    return result
@@ -0,0 +1,310 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from ledger import BudgetExceeded
+
+# per-request latency budget, the planner never starts a path it does not expect to finish in time
+budget_ms = float(os.getenv("PLANNER_BUDGET_MS", "5000"))
+# how long past the budget the planner still waits for a path when nothing answered in time
+overrun_ms = float(os.getenv("PLANNER_OVERRUN_MS", str(budget_ms)))
+# paths expected to be faster than this are tried first, before anything slower is started
+fast_path_ms = float(os.getenv("PLANNER_FAST_PATH_MS", "50"))
+# how many slow paths may run in parallel and how close their scores must be to be hedged
+max_parallel = int(os.getenv("PLANNER_MAX_PARALLEL", "2"))
+hedge_margin = float(os.getenv("PLANNER_HEDGE_MARGIN", "0.1"))
+# how much a full budget of latency and a thousand tokens cost in units of accuracy
+latency_weight = float(os.getenv("PLANNER_LATENCY_WEIGHT", "0.3"))
+token_weight = float(os.getenv("PLANNER_TOKEN_WEIGHT", "0.05"))
+# share of requests that also run a path the plan left out, so a path that was slow once is not dropped for good
+explore_rate = float(os.getenv("PLANNER_EXPLORE_RATE", "0.05"))
+
+# weight of a new observation in the moving averages
+alpha = 0.2
+# how many observations the priors are worth
+prior_weight = 5
+decision_history = 200
+
+# expected latency in ms, tokens, answer rate and accuracy of each path before anything was learned
+path_priors = {
+    "cache": {"latency_ms": 1, "tokens": 0, "answer_rate": 0.2, "accuracy": 0.9},
+    "facts": {"latency_ms": 10, "tokens": 150, "answer_rate": 0.3, "accuracy": 0.85},
+    "rag": {"latency_ms": 1500, "tokens": 1500, "answer_rate": 0.95, "accuracy": 0.7},
+    "tools": {"latency_ms": 2500, "tokens": 800, "answer_rate": 0.95, "accuracy": 0.75},
+    "llm": {"latency_ms": 1000, "tokens": 150, "answer_rate": 1.0, "accuracy": 0.4},
+}
+
+
+def normalize_answer(answer):
+    return " ".join((answer or "").lower().strip(" .").split())
+
+
+class PathStats:
+    """
+    Learned latency, token cost, answer rate and accuracy of one path for one question type.
+    """
+
+    def __init__(self, prior):
+        self.latency_ms = prior["latency_ms"]
+        self.tokens = prior["tokens"]
+        self.answered = prior["answer_rate"] * prior_weight
+        self.runs = prior_weight
+        self.correct = prior["accuracy"] * prior_weight
+        self.judged = prior_weight
+        self.errors = 0
+
+    def record_run(self, latency_ms, tokens, answered):
+        self.latency_ms += alpha * (latency_ms - self.latency_ms)
+        self.runs += 1
+        if answered:
+            self.answered += 1
+            self.tokens += alpha * (tokens - self.tokens)
+
+    def record_feedback(self, correct):
+        self.judged += 1
+        if correct:
+            self.correct += 1
+
+    def answer_rate(self):
+        return self.answered / self.runs
+
+    def accuracy(self):
+        return self.correct / self.judged
+
+    def score(self):
+        return (self.answer_rate() * self.accuracy()
+                - latency_weight * self.latency_ms / budget_ms
+                - token_weight * self.tokens / 1000)
+
+    def as_dict(self):
+        return {
+            "latencyMs": round(self.latency_ms, 1),
+            "tokens": round(self.tokens, 1),
+            "answerRate": round(self.answer_rate(), 3),
+            "accuracy": round(self.accuracy(), 3),
+            "score": round(self.score(), 3),
+            "runs": self.runs - prior_weight,
+            "errors": self.errors,
+        }
+
+
+class Planner:
+    """
+    Chooses per question which paths to run and in which order. A plan is a
+    list of stages, the paths of a stage run in parallel and the first stage
+    that produces an answer wins.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.decisions = OrderedDict()
+        self.recent = deque(maxlen=decision_history)
+        # the event loop only keeps weak references to tasks, losing paths keep running in here
+        self.background = set()
+        self.random = random.Random()
+
+    def stats_for(self, path, question_type):
+        key = (path, question_type)
+        if key not in self.stats:
+            self.stats[key] = PathStats(path_priors[path])
+        return self.stats[key]
+
+    def plan(self, question_type, budget=budget_ms):
+        with self.lock:
+            scores = {p: self.stats_for(p, question_type).score() for p in self.paths}
+            latencies = {p: self.stats_for(p, question_type).latency_ms for p in self.paths}
+        ranked = sorted(self.paths, key=lambda p: scores[p], reverse=True)
+
+        stages = []
+        fast = [p for p in ranked if latencies[p] <= fast_path_ms]
+        if fast:
+            stages.append(fast)
+
+        slow = [p for p in ranked if p not in fast and latencies[p] <= budget]
+        if not slow:
+            # nothing fits the budget, fall back to the fastest of the slow paths
+            slow = sorted([p for p in ranked if p not in fast], key=lambda p: latencies[p])[:1]
+        if slow:
+            best = slow[0]
+            stage = [best]
+            for p in slow[1:]:
+                if len(stage) < max_parallel and scores[p] >= scores[best] - hedge_margin:
+                    stage.append(p)
+            stages.append(stage)
+            rest = [p for p in slow if p not in stage]
+            if rest:
+                stages.append(rest[:1])
+
+        planned = set(p for stage in stages for p in stage)
+        left_out = [p for p in ranked if p not in planned]
+        if left_out and self.random.random() < explore_rate:
+            # run the path that was observed least next to the best slow path, the first answer still wins
+            with self.lock:
+                explore = min(left_out, key=lambda p: self.stats_for(p, question_type).runs)
+            slow_stage = 1 if fast else 0
+            if len(stages) > slow_stage:
+                stages[slow_stage].append(explore)
+            else:
+                stages.append([explore])
+        return stages
+
+    async def answer(self, ask, stages=None, budget=budget_ms):
+        question_type = ask.type.value
+        if stages is None:
+            stages = self.plan(question_type, budget)
+        decision = {
+            "correlationToken": ask.correlationToken,
+            "question": ask.question,
+            "type": question_type,
+            "budgetMs": budget,
+            "plan": stages,
+            "paths": [],
+            "chosen": None,
+            "overBudget": False,
+        }
+        start = time.perf_counter()
+        pending = set()
+        chosen = None
+
+        for stage in stages:
+            remaining = budget - (time.perf_counter() - start) * 1000
+            if remaining <= 0:
+                decision["overBudget"] = True
+                break
+            tasks = {asyncio.create_task(self.run_path(p, ask, decision)) for p in stage}
+            pending |= tasks
+            chosen, pending = await self.first_answer(pending, remaining / 1000)
+            if chosen is not None:
+                break
+
+        if chosen is None and pending:
+            # out of budget without an answer, take whatever finishes first within the overrun
+            decision["overBudget"] = True
+            chosen, pending = await self.first_answer(pending, overrun_ms / 1000)
+
+        # paths still running after the winner are left to finish so their timings are learned
+        for task in pending:
+            self.background.add(task)
+            task.add_done_callback(self.background.discard)
+        decision["totalMs"] = round((time.perf_counter() - start) * 1000, 1)
+        if chosen is not None:
+            decision["chosen"] = chosen[0]
+        self.remember(decision)
+        return chosen[1] if chosen is not None else None, decision
+
+    async def first_answer(self, tasks, timeout):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while tasks:
+            remaining = None if deadline is None else max(0, deadline - time.perf_counter())
+            done, tasks = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                path, result = task.result()
+                if result is not None and result.answer:
+                    return (path, result), tasks
+        return None, tasks
+
+    async def run_path(self, path, ask, decision):
+        question_type = ask.type.value
+        start = time.perf_counter()
+        result = None
+        error = None
+        cut_off = False
+        try:
+            result = await asyncio.to_thread(self.paths[path], ask)
+        except BudgetExceeded as e:
+            # refused by the ledger, this says nothing about how the path performs
+            print("Path " + path + " was cut off: " + str(e))
+            cut_off = True
+        except Exception as e:
+            print("Path " + path + " failed: " + str(e))
+            error = str(e)
+        latency_ms = (time.perf_counter() - start) * 1000
+        answered = result is not None and bool(result.answer)
+        tokens = result.prompt_tokens + result.completion_tokens if result is not None else 0
+        if not cut_off:
+            with self.lock:
+                stats = self.stats_for(path, question_type)
+                stats.record_run(latency_ms, tokens, answered)
+                if error is not None:
+                    stats.errors += 1
+        decision["paths"].append({
+            "path": path,
+            "latencyMs": round(latency_ms, 1),
+            "tokens": tokens,
+            "answered": answered,
+            "answer": result.answer if answered else None,
+            "error": error,
+            "cutOff": cut_off,
+        })
+        return path, result
+
+    def remember(self, decision):
+        with self.lock:
+            self.recent.append(decision)
+            if decision["correlationToken"] is not None:
+                self.decisions[decision["correlationToken"]] = decision
+                while len(self.decisions) > decision_history:
+                    self.decisions.popitem(last=False)
+
+    def record_feedback(self, correlation_token, correct):
+        """
+        Learn the accuracy of the paths that answered the question with this
+        correlation token and return its decision, or None if it is unknown.
+        Paths that lost the race are judged by comparing their answer with the
+        chosen one, as far as that tells whether they were right.
+        """
+        with self.lock:
+            decision = self.decisions.get(correlation_token)
+            if decision is None or decision["chosen"] is None:
+                return None
+            answers = {p["path"]: p["answer"] for p in decision["paths"] if p["answered"]}
+            chosen_answer = normalize_answer(answers.get(decision["chosen"]))
+            for path, answer in answers.items():
+                if path == decision["chosen"]:
+                    path_correct = correct
+                elif normalize_answer(answer) == chosen_answer:
+                    path_correct = correct
+                elif correct:
+                    path_correct = False
+                else:
+                    # a different answer to a wrong one may or may not be right
+                    continue
+                self.stats_for(path, decision["type"]).record_feedback(path_correct)
+            decision["correct"] = correct
+        return decision
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    async def drain(self):
+        """
+        Wait for the paths that lost the race, e.g. to read the complete usage of a request.
+        """
+        if self.background:
+            await asyncio.wait(set(self.background))
+
+    def report(self):
+        with self.lock:
+            return {
+                "settings": {
+                    "budgetMs": budget_ms,
+                    "overrunMs": overrun_ms,
+                    "fastPathMs": fast_path_ms,
+                    "maxParallel": max_parallel,
+                    "hedgeMargin": hedge_margin,
+                    "latencyWeight": latency_weight,
+                    "tokenWeight": token_weight,
+                },
+                "stats": {
+                    question_type: {p: s.as_dict() for (p, t), s in self.stats.items() if t == question_type}
+                    for question_type in sorted(set(t for _, t in self.stats))
+                },
+                "decisions": list(self.recent),
+            }
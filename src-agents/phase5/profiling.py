@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from collections import Counter
+
+profile_dir = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# event loop stalls longer than this count as blocking
+block_threshold_ms = float(os.getenv("PROFILE_BLOCK_THRESHOLD_MS", "10"))
+
+# leaf frames of threads that are just waiting for work, they are left out of the flamegraph
+idle_frames = {("selectors.py", "select"), ("selectors.py", "EpollSelector.select"),
+               ("thread.py", "_worker"), ("threading.py", "wait"), ("threading.py", "Condition.wait")}
+# leaf frames of threads that are waiting on the network
+io_modules = {"socket.py", "ssl.py", "connection.py", "connectionpool.py", "_backends/sync.py"}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), getattr(code, "co_qualname", code.co_name))
+
+
+def request_tag(frame):
+    """
+    Find the Ask a stack is working on by looking for an `ask` local, the
+    /ask handler and every planner path receive one.
+    """
+    while frame is not None:
+        if "ask" in frame.f_code.co_varnames:
+            ask = frame.f_locals.get("ask")
+            if hasattr(ask, "correlationToken") and hasattr(ask, "type"):
+                return getattr(ask.type, "value", ask.type), ask.correlationToken
+        frame = frame.f_back
+    return None, None
+
+
+class Profiler:
+    """
+    Stack sampler that can be armed for the next N requests or a time window.
+    While it is not armed the only cost is checking `active` once per request.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.last_result = None
+        self.sampler = None
+        self.monitor = None
+        self.runs = 0
+
+    def start(self, requests=None, seconds=None, interval_ms=5):
+        with self.lock:
+            # the threads of the previous profile must be gone before their counters are reset
+            if self.active or (self.sampler is not None and self.sampler.is_alive()):
+                return False
+            if self.monitor is not None and not self.monitor.done():
+                return False
+            self.runs += 1
+            self.remaining_requests = requests
+            self.deadline = time.monotonic() + seconds if seconds is not None else None
+            self.interval = interval_ms / 1000
+            self.started_at = time.time()
+            self.requests = 0
+            self.stacks = Counter()
+            self.by_type = Counter()
+            self.by_token = Counter()
+            self.self_frames = Counter()
+            self.samples = 0
+            self.io_samples = 0
+            self.loop_busy = 0
+            self.loop_idle = 0
+            self.blocked_ms = 0.0
+            self.max_block_ms = 0.0
+            self.blocks = 0
+            self.loop_thread = threading.get_ident()
+            self.active = True
+            self.sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.monitor = asyncio.get_running_loop().create_task(self.watch_event_loop())
+        self.sampler.start()
+        print("Profiling started for {} requests / {} seconds".format(requests, seconds))
+        return True
+
+    def request_finished(self):
+        with self.lock:
+            self.requests += 1
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+                if self.remaining_requests <= 0:
+                    self.active = False
+
+    def stop(self):
+        self.active = False
+
+    async def watch_event_loop(self):
+        # an event loop that is blocked wakes up from a short sleep too late
+        loop = asyncio.get_running_loop()
+        while self.active:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = (loop.time() - before - self.interval) * 1000
+            if lag_ms >= block_threshold_ms:
+                self.blocked_ms += lag_ms
+                self.blocks += 1
+                self.max_block_ms = max(self.max_block_ms, lag_ms)
+
+    def sample(self):
+        own_thread = threading.get_ident()
+        try:
+            while self.active:
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    break
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    self.record(thread_id, frame, names)
+                time.sleep(self.interval)
+        finally:
+            # whatever happened, the profiler must not stay armed
+            self.active = False
+        self.last_result = self.write()
+
+    def record(self, thread_id, frame, names):
+        leaf = frame_name(frame)
+        module, _, function = leaf.partition(":")
+        is_loop = thread_id == self.loop_thread
+        if (module, function) in idle_frames:
+            if is_loop:
+                self.loop_idle += 1
+            return
+        if is_loop:
+            self.loop_busy += 1
+
+        stack = []
+        current = frame
+        while current is not None:
+            stack.append(frame_name(current))
+            current = current.f_back
+        stack.reverse()
+        question_type, token = request_tag(frame)
+        thread_name = "event-loop" if is_loop else names.get(thread_id, str(thread_id))
+
+        self.samples += 1
+        self.self_frames[leaf] += 1
+        if module in io_modules:
+            self.io_samples += 1
+        if question_type is not None:
+            self.by_type[question_type] += 1
+            self.by_token[token] += 1
+        tags = ["type={}".format(question_type or "untagged"),
+                "token={}".format(token or "untagged"), thread_name]
+        self.stacks[";".join(tags + stack)] += 1
+
+    def write(self):
+        os.makedirs(profile_dir, exist_ok=True)
+        # several profiles can start within the same second
+        name = "{}-{:06d}-{}-{}".format(time.strftime("profile-%Y%m%d-%H%M%S", time.gmtime(self.started_at)),
+                                        int(self.started_at % 1 * 1000000), os.getpid(), self.runs)
+        collapsed_path = os.path.join(profile_dir, name + ".collapsed")
+        with open(collapsed_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+        loop_samples = self.loop_busy + self.loop_idle
+        summary = {
+            "file": collapsed_path,
+            "durationSeconds": round(time.time() - self.started_at, 2),
+            "requests": self.requests,
+            "samples": self.samples,
+            "intervalMs": self.interval * 1000,
+            "ioWaitSamples": self.io_samples,
+            "byQuestionType": dict(self.by_type),
+            "byCorrelationToken": dict(self.by_token.most_common(20)),
+            "topSelfFrames": self.self_frames.most_common(15),
+            "eventLoop": {
+                "busyRatio": self.loop_busy / loop_samples if loop_samples else None,
+                "blockedMs": round(self.blocked_ms, 1),
+                "blocks": self.blocks,
+                "maxBlockMs": round(self.max_block_ms, 1),
+            },
+        }
+        with open(os.path.join(profile_dir, name + ".json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        print("Profiling finished, wrote " + collapsed_path)
+        return summary
+
+    def status(self):
+        running = self.active or (self.sampler is not None and self.sampler.is_alive())
+        return {"active": running, "lastResult": self.last_result}
@@ -0,0 +1,114 @@
+import time
+import types
+import asyncio
+import threading
+import contextvars
+import pytest
+import ledger
+from ledger import Ledger, BudgetExceeded
+from planner import Planner
+from test_planner import make_ask
+
+
+def fake_create(tokens=100, delay=0.0, error=None):
+    def create(**kwargs):
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return types.SimpleNamespace(usage=types.SimpleNamespace(prompt_tokens=tokens, completion_tokens=0))
+    return create
+
+
+def prompt(tokens):
+    return [{"role": "user", "content": " hello" * tokens}]
+
+
+def start_request(service):
+    context = contextvars.copy_context()
+    request = context.run(service.start, "estimation", "t")
+    return context, request
+
+
+def test_parallel_calls_cannot_overbook_the_request_budget(monkeypatch):
+    monkeypatch.setattr(ledger, "request_token_budget", 1000)
+    service = Ledger()
+    context, request = start_request(service)
+    results = []
+
+    def run():
+        try:
+            ledger.call("rag.completion", fake_create(delay=0.1), messages=prompt(100), max_tokens=200)
+            results.append("ok")
+        except BudgetExceeded:
+            results.append("cut")
+
+    # every thread runs in a copy of the request context, like asyncio.to_thread does
+    threads = [threading.Thread(target=context.copy().run, args=(run,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # each call reserves at least 300 tokens, only three fit in the budget at once
+    assert results.count("ok") <= 3
+    assert results.count("cut") >= 3
+    assert request.reserved == 0
+    assert service.report()["reservedTokens"] == 0
+    assert service.report()["cutoffs"]["rag.completion"] == results.count("cut")
+
+
+def test_failed_call_releases_its_reservation(monkeypatch):
+    monkeypatch.setattr(ledger, "request_token_budget", 1000)
+    service = Ledger()
+    context, request = start_request(service)
+
+    with pytest.raises(RuntimeError):
+        context.run(ledger.call, "llm.completion", fake_create(error=RuntimeError("timeout")),
+                    messages=prompt(100), max_tokens=800)
+    assert request.reserved == 0
+    assert service.minute_reserved == 0
+    assert request.total.tokens() == 0
+
+    # the whole budget is available again
+    context.run(ledger.call, "llm.completion", fake_create(), messages=prompt(100), max_tokens=800)
+    assert request.total.tokens() == 100
+
+
+def test_completion_limit_counts_against_the_budget(monkeypatch):
+    monkeypatch.setattr(ledger, "request_token_budget", 1000)
+    context, request = start_request(Ledger())
+    context.run(ledger.call, "facts.completion", fake_create(), messages=prompt(100), max_tokens=100)
+    with pytest.raises(BudgetExceeded):
+        context.run(ledger.call, "facts.completion", fake_create(), messages=prompt(100), max_tokens=900)
+    assert request.reserved == 0
+
+
+def test_minute_budget_is_shared_by_requests(monkeypatch):
+    monkeypatch.setattr(ledger, "request_token_budget", 0)
+    monkeypatch.setattr(ledger, "minute_token_budget", 500)
+    service = Ledger()
+    first, _ = start_request(service)
+    second, request = start_request(service)
+
+    first.run(ledger.call, "llm.completion", fake_create(tokens=400), messages=prompt(10))
+    with pytest.raises(BudgetExceeded):
+        second.run(ledger.call, "llm.completion", fake_create(), messages=prompt(10), max_tokens=200)
+    # a refused minute reservation must not leave the request reservation behind
+    assert request.reserved == 0
+    assert service.report()["lastMinuteTokens"] == 400
+
+
+def test_budget_cut_off_is_not_learned_as_a_path_run():
+    def cut_off(ask):
+        raise BudgetExceeded("llm.completion would use 900 tokens")
+
+    p = Planner({"rag": cut_off, "llm": lambda ask: None})
+    p.random.random = lambda: 1.0
+    runs = p.stats_for("rag", "estimation").runs
+    result, decision = asyncio.run(p.answer(make_ask(), stages=[["rag"], ["llm"]]))
+
+    stats = p.stats_for("rag", "estimation")
+    assert stats.runs == runs
+    assert stats.errors == 0
+    assert decision["paths"][0]["cutOff"]
+    assert decision["paths"][0]["error"] is None
@@ -0,0 +1,119 @@
+import time
+import asyncio
+import types
+import planner
+from planner import Planner
+from paths import PathResult
+
+
+def make_ask(token="t", question_type="estimation"):
+    return types.SimpleNamespace(question="How long is it?", type=types.SimpleNamespace(value=question_type),
+                                 correlationToken=token)
+
+
+def stub(answer, delay=0.0, tokens=10, error=None):
+    def path(ask):
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return PathResult(answer, prompt_tokens=tokens) if answer is not None else None
+    return path
+
+
+def no_exploration(paths):
+    p = Planner(paths)
+    p.random.random = lambda: 1.0
+    return p
+
+
+def test_first_stage_with_an_answer_wins():
+    p = no_exploration({"cache": stub(None), "llm": stub("42")})
+    result, decision = asyncio.run(p.answer(make_ask(), stages=[["cache"], ["llm"]]))
+    assert result.answer == "42"
+    assert decision["chosen"] == "llm"
+    assert [r["path"] for r in decision["paths"]] == ["cache", "llm"]
+
+
+def test_failing_path_falls_back_to_the_next_stage():
+    p = no_exploration({"tools": stub(None, error=RuntimeError("boom")), "llm": stub("42")})
+    result, decision = asyncio.run(p.answer(make_ask(), stages=[["tools"], ["llm"]]))
+    assert result.answer == "42"
+    assert p.stats_for("tools", "estimation").errors == 1
+
+
+def test_hedged_paths_return_the_faster_answer():
+    p = no_exploration({"rag": stub("slow", delay=0.3), "tools": stub("fast", delay=0.01)})
+
+    async def run():
+        result, decision = await p.answer(make_ask(), stages=[["rag", "tools"]], budget=1000)
+        assert result.answer == "fast"
+        # the loser keeps running and is learned once it finishes
+        await p.drain()
+        return decision
+
+    decision = asyncio.run(run())
+    assert sorted(r["path"] for r in decision["paths"]) == ["rag", "tools"]
+    assert p.stats_for("rag", "estimation").runs == planner.prior_weight + 1
+
+
+def test_overrun_bounds_the_wait(monkeypatch):
+    monkeypatch.setattr(planner, "overrun_ms", 100)
+    p = no_exploration({"llm": stub("late", delay=1.0)})
+
+    async def run():
+        start = time.perf_counter()
+        result, decision = await p.answer(make_ask(), stages=[["llm"]], budget=100)
+        elapsed = time.perf_counter() - start
+        await p.drain()
+        return result, decision, elapsed
+
+    result, decision, elapsed = asyncio.run(run())
+    assert result is None
+    assert decision["overBudget"]
+    assert elapsed < 0.5
+
+
+def test_answer_within_the_overrun_is_taken(monkeypatch):
+    monkeypatch.setattr(planner, "overrun_ms", 500)
+    p = no_exploration({"llm": stub("late", delay=0.2)})
+    result, decision = asyncio.run(p.answer(make_ask(), stages=[["llm"]], budget=50))
+    assert result.answer == "late"
+    assert decision["overBudget"]
+
+
+def test_plan_drops_paths_over_the_budget():
+    p = no_exploration({"cache": stub(None), "rag": stub("a"), "tools": stub("b"), "llm": stub("c")})
+    p.stats_for("tools", "estimation").latency_ms = 20000
+    stages = p.plan("estimation", budget=5000)
+    assert stages[0] == ["cache"]
+    assert "tools" not in [path for stage in stages for path in stage]
+
+
+def test_exploration_runs_a_path_left_out_of_the_plan():
+    p = Planner({"cache": stub(None), "rag": stub("a"), "tools": stub("b"), "llm": stub("c")})
+    p.random.random = lambda: 0.0
+    p.stats_for("tools", "estimation").latency_ms = 20000
+    stages = p.plan("estimation", budget=5000)
+    assert "tools" in stages[1]
+
+    result, decision = asyncio.run(p.answer(make_ask(), stages=stages))
+    asyncio.run(p.drain())
+    assert p.stats_for("tools", "estimation").runs > planner.prior_weight
+
+
+def test_feedback_teaches_paths_that_lost():
+    p = no_exploration({"rag": stub("Paris", delay=0.01), "tools": stub("paris.", delay=0.05),
+                        "llm": stub("London", delay=0.05)})
+
+    async def run():
+        await p.answer(make_ask("t1"), stages=[["rag", "tools", "llm"]], budget=1000)
+        await p.drain()
+
+    asyncio.run(run())
+    judged = {path: p.stats_for(path, "estimation").judged for path in ["rag", "tools", "llm"]}
+    p.record_feedback("t1", True)
+    assert p.stats_for("rag", "estimation").judged == judged["rag"] + 1
+    # the same answer is as right as the chosen one, a different one is wrong
+    assert p.stats_for("tools", "estimation").correct == planner.path_priors["tools"]["accuracy"] * planner.prior_weight + 1
+    assert p.stats_for("llm", "estimation").judged == judged["llm"] + 1
+    assert p.stats_for("llm", "estimation").correct == planner.path_priors["llm"]["accuracy"] * planner.prior_weight
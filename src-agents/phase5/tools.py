@@ -0,0 +1,46 @@
+import requests
+
+smoorghApi = "https://smoorgh-api.happypebble-f6fb3666.northeurope.azurecontainerapps.io/"
+
+
+def get_movie_fact(kind, title, facts=None):
+    """
+    Look up a fact about a movie, preferring the facts precomputed during warm-up
+    over a call to the Smoorgh api.
+    """
+    if facts is not None and kind in facts.get(title, {}):
+        return facts[title][kind]
+    try:
+        headers = {"title": title}
+        response = requests.get(f"{smoorghApi}{kind}", headers=headers, timeout=10)
+        print('The api response for ' + kind + ' is:', response.text)
+        return response.text
+
+    except requests.RequestException:
+        return "Sorry, I couldn't find a " + kind + " for that movie."
+
+
+def tool_definition(kind):
+    return {
+        "type": "function",
+        "function": {
+                "name": "get_movie_" + kind,
+                "description": "Gets the " + kind + " of a movie",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "title": {
+                            "type": "string",
+                            "description": "The movie name. The movie name should be a string without quotation marks.",
+                        }
+                    },
+                    "required": ["title"],
+                },
+        }
+    }
+
+
+fact_kinds = ["rating", "year", "actor", "location", "genre"]
+
+functions = [tool_definition(kind) for kind in fact_kinds]
+available_functions = {"get_movie_" + kind: kind for kind in fact_kinds}
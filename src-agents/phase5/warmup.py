@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import requests
+from tools import smoorghApi, fact_kinds
+
+# where the warm-up looks for its inputs, all relative to the container working directory
+snapshot_path = os.getenv("WARMUP_SNAPSHOT", "warmup_snapshot.json")
+movies_path = os.getenv("WARMUP_MOVIES", "movies.json")
+question_log_path = os.getenv("WARMUP_QUESTION_LOG", "questions.jsonl")
+
+# bounded parallelism so a fresh replica does not flood the upstreams
+max_workers = int(os.getenv("WARMUP_MAX_WORKERS", "8"))
+embedding_batch_size = int(os.getenv("WARMUP_EMBEDDING_BATCH_SIZE", "16"))
+hot_question_count = int(os.getenv("WARMUP_HOT_QUESTIONS", "200"))
+# readiness is not withheld longer than this, whatever did not finish by then is left out
+warmup_deadline_seconds = float(os.getenv("WARMUP_DEADLINE_SECONDS", "120"))
+# the least recently used answers are evicted beyond this many entries
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+
+# the hit rate is reported for this many seconds after the replica became ready
+first_minute_seconds = 60
+
+
+def normalize_question(question):
+    return " ".join((question or "").lower().split())
+
+
+def normalize_vector(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def movie_as_text(movie):
+    return "Movie Title: {} Release Year: {} Movie Plot: {}".format(
+        movie["title"], movie["year"], movie["plot"])
+
+
+class AnswerCache:
+    """
+    In-memory LRU cache of answered questions, looked up by normalized text.
+    """
+
+    def __init__(self, max_entries=answer_cache_size):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.ready_at = None
+        self.hits = 0
+        self.misses = 0
+        self.first_minute_hits = 0
+        self.first_minute_misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, question, question_type, answer):
+        key = (normalize_question(question), question_type)
+        entry = {"question": question, "type": question_type, "answer": answer}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, question, question_type):
+        with self.lock:
+            self.entries.pop((normalize_question(question), question_type), None)
+
+    def get(self, question, question_type):
+        key = (normalize_question(question), question_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            self.record(entry is not None)
+        return entry["answer"] if entry is not None else None
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.ready_at is not None and time.time() - self.ready_at <= first_minute_seconds:
+            if hit:
+                self.first_minute_hits += 1
+            else:
+                self.first_minute_misses += 1
+
+    def stats(self):
+        first_minute_total = self.first_minute_hits + self.first_minute_misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "firstMinuteRequests": first_minute_total,
+            "firstMinuteHitRate": self.first_minute_hits / first_minute_total if first_minute_total else None,
+        }
+
+
+class WarmState:
+    """
+    Everything a replica precomputes before it reports ready: hot answers,
+    movie embeddings and Smoorgh facts.
+    """
+
+    def __init__(self):
+        self.answers = AnswerCache()
+        self.movies = []
+        # normalized embeddings of self.movies, one row per movie
+        self.movie_vectors = None
+        self.facts = {}
+        self.ready = False
+        self.error = None
+        self.degraded = []
+        self.source = None
+        self.started_at = None
+        self.time_to_warm = None
+
+    def run(self, client, embedding_model, answer_fn=None):
+        self.started_at = time.time()
+        try:
+            if os.path.exists(snapshot_path):
+                print("Loading warm-up snapshot from " + snapshot_path)
+                self.load_snapshot(snapshot_path)
+                self.source = "snapshot"
+            else:
+                print("No warm-up snapshot found, building from " +
+                      movies_path + " and " + question_log_path)
+                self.build(client, embedding_model, answer_fn)
+                self.source = "built"
+                if self.degraded:
+                    # a partial snapshot would be loaded by every later start and never completed
+                    print("Not saving the warm-up snapshot, warm-up degraded: " + "; ".join(self.degraded))
+                else:
+                    self.save_snapshot(snapshot_path)
+        except Exception as e:
+            # a failed warm-up still lets the replica serve, just cold
+            print("Warm-up failed: " + str(e))
+            self.error = str(e)
+            self.source = "cold"
+        self.time_to_warm = time.time() - self.started_at
+        self.answers.ready_at = time.time()
+        self.ready = True
+        print("Warm-up finished in {:.1f}s from {}: {} answers, {} movies, {} facts".format(
+            self.time_to_warm, self.source, len(self.answers), len(self.movies), len(self.facts)))
+
+    def build(self, client, embedding_model, answer_fn=None):
+        deadline = time.monotonic() + warmup_deadline_seconds
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            movies = load_movies(movies_path)
+            hot_questions = load_hot_questions(question_log_path)
+
+            movie_vectors = embed_all(
+                executor, client, embedding_model, [movie_as_text(m) for m in movies], deadline)
+            # movies of a failed embedding batch are left out of the rag context
+            embedded = [(movie, vector) for movie, vector in zip(movies, movie_vectors) if vector is not None]
+            if len(embedded) < len(movies):
+                self.degraded.append("{} movies without an embedding".format(len(movies) - len(embedded)))
+            self.movies = [movie for movie, _ in embedded]
+            self.movie_vectors = normalize_vector([vector for _, vector in embedded]) if embedded else None
+
+            titles = sorted(set(m["title"] for m in movies))
+            incomplete = 0
+            for title, result in zip(titles, map_until(executor, lambda t: fetch_facts(t, deadline), titles, deadline)):
+                if result is None:
+                    incomplete += 1
+                    continue
+                self.facts[title], complete = result
+                if not complete:
+                    incomplete += 1
+            if incomplete:
+                self.degraded.append("facts of {} titles incomplete".format(incomplete))
+
+            # only questions without a logged answer need a round trip to the llm, the ones that fail
+            # are answered by the planner when they are asked
+            unanswered = [q for q in hot_questions if not q.get("answer")]
+            if answer_fn is not None:
+                for question, answer in zip(unanswered, map_until(executor, safe_answer(answer_fn), unanswered, deadline)):
+                    question["answer"] = answer
+            for question in hot_questions:
+                if question.get("answer"):
+                    self.answers.put(question["question"], question["type"], question["answer"])
+            if time.monotonic() >= deadline:
+                self.degraded.append("deadline of {}s reached".format(warmup_deadline_seconds))
+        finally:
+            # threads still waiting on an upstream are left to time out instead of being waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def load_snapshot(self, path):
+        with open(path) as f:
+            snapshot = json.load(f)
+        for entry in snapshot.get("answers", []):
+            self.answers.put(entry["question"], entry["type"], entry["answer"])
+        movies = snapshot.get("movies", [])
+        self.movie_vectors = normalize_vector([m.pop("vector") for m in movies]) if movies else None
+        self.movies = movies
+        self.facts = snapshot.get("facts", {})
+
+    def save_snapshot(self, path):
+        with self.answers.lock:
+            answers = list(self.answers.entries.values())
+        snapshot = {
+            "answers": answers,
+            "movies": [dict(movie, vector=vector.tolist()) for movie, vector in zip(self.movies, self.movie_vectors)]
+                      if self.movies else [],
+            "facts": self.facts,
+        }
+        try:
+            with open(path, "w") as f:
+                json.dump(snapshot, f)
+            print("Saved warm-up snapshot to " + path)
+        except OSError as e:
+            print("Could not save warm-up snapshot: " + str(e))
+
+    def status(self):
+        return {
+            "status": "ready" if self.ready else "warming",
+            "source": self.source,
+            "error": self.error,
+            "degraded": self.degraded,
+            "timeToWarmSeconds": self.time_to_warm,
+            "movies": len(self.movies),
+            "facts": len(self.facts),
+            "answerCache": self.answers.stats(),
+        }
+
+
+def load_movies(path):
+    with open(path) as f:
+        raw_movies = json.load(f)
+    return [
+        {
+            "title": m["movie_title"],
+            "genre": m["movie_genre"],
+            "year": m["movie_year"],
+            "rating": m["movie_rating"],
+            "plot": m["movie_plot"],
+        }
+        for m in raw_movies
+    ]
+
+
+def load_hot_questions(path, limit=hot_question_count):
+    """
+    Read a question log with one Ask per line (optionally with an answer) and
+    return the most frequently asked questions.
+    """
+    if not os.path.exists(path):
+        return []
+    counts = Counter()
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not entry.get("question") or not entry.get("type"):
+                continue
+            key = (normalize_question(entry["question"]), entry["type"])
+            counts[key] += 1
+            if entry.get("answer") or key not in latest:
+                latest[key] = entry
+    return [dict(latest[key]) for key, _ in counts.most_common(limit)]
+
+
+def map_until(executor, fn, items, deadline):
+    """
+    executor.map that gives up at the deadline, items that did not finish by then map to None.
+    """
+    futures = [executor.submit(fn, item) for item in items]
+    wait(futures, timeout=max(0, deadline - time.monotonic()))
+    return [f.result() if f.done() and not f.cancelled() else None for f in futures]
+
+
+def embed_all(executor, client, embedding_model, texts, deadline):
+    batches = [texts[i:i + embedding_batch_size]
+               for i in range(0, len(texts), embedding_batch_size)]
+
+    def embed_batch(batch):
+        try:
+            response = client.embeddings.create(input=batch, model=embedding_model)
+            return [d.embedding for d in response.data]
+        except Exception as e:
+            print("Warm-up could not embed a batch: " + str(e))
+            return [None] * len(batch)
+
+    vectors = []
+    for batch, batch_vectors in zip(batches, map_until(executor, embed_batch, batches, deadline)):
+        vectors.extend(batch_vectors if batch_vectors is not None else [None] * len(batch))
+    return vectors
+
+
+def safe_answer(answer_fn):
+    # one failing question, e.g. a content filter hit, must not cost the other answers
+    def answer(question):
+        try:
+            return answer_fn(question)
+        except Exception as e:
+            print("Warm-up could not answer " + repr(question.get("question")) + ": " + str(e))
+            return None
+    return answer
+
+
+def fetch_facts(title, deadline):
+    """
+    Return the facts of a title and whether every kind could be asked for.
+    """
+    facts = {}
+    complete = True
+    for kind in fact_kinds:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return facts, False
+        try:
+            response = requests.get(
+                f"{smoorghApi}{kind}", headers={"title": title}, timeout=min(10, remaining))
+            if response.ok:
+                facts[kind] = response.text
+        except requests.RequestException:
+            complete = False
+    return facts, complete
+
+
+if __name__ == "__main__":
+    # build the snapshot artifact ahead of time, e.g. before building the image
+    from main import client, embedding_model, answer_for_warmup
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+    WarmState().run(client, embedding_model, answer_for_warmup)